@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the XOR and AES-GCM payload formats in generate_site.py.
+Times encryption in the generator and decryption with the page's own
+decoder, run under Node.js (whose WebCrypto, like the browser's, uses
+native AES code). Needs the cryptography package, and node for the
+decrypt columns.
+Usage: python benchmarks/bench_decrypt.py [size_mb ...]
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+from generate_site import AESGCM, PAYLOAD_DECODER_JS, aes_gcm_encrypt, xor_bytes
+
+# A SHA-256 hex digest, like the real password-hash keys
+KEY = 'b55c8792d1ce458e279308835f8a97b580263503e76e1998e279703e35ad0c2e'
+NONCE = bytes(12)
+DEFAULT_SIZES_MB = [1, 10, 100]
+
+# Decrypts each payload file in turn with the page's decoder and prints
+# the fastest of several runs, in milliseconds, as JSON
+NODE_BENCH = textwrap.dedent(PAYLOAD_DECODER_JS) + """
+const fs = require('fs');
+(async () => {
+    const [xorPath, aesPath, repeat] = process.argv.slice(2);
+    const time = async (path, decrypt) => {
+        let best = Infinity;
+        for (let i = 0; i < Number(repeat); i++) {
+            const bytes = new Uint8Array(fs.readFileSync(path));
+            const start = performance.now();
+            await decrypt(bytes);
+            best = Math.min(best, performance.now() - start);
+        }
+        return best;
+    };
+    console.log(JSON.stringify({
+        xor: await time(xorPath, bytes => xorDecrypt(bytes, '%s')),
+        aes: await time(aesPath, bytes => aesGcmDecrypt(bytes, '%s')),
+    }));
+})();
+""" % (KEY, KEY)
+
+def best_of(func, repeat):
+    """Fastest of repeat runs, in seconds, plus the last result."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def node_decrypt_times(node, xor_payload, aes_payload, repeat):
+    """Decrypt times in seconds for both payloads, using the page's decoder."""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        (tmp / 'bench.js').write_text(NODE_BENCH, encoding='utf-8')
+        (tmp / 'xor.bin').write_bytes(xor_payload)
+        (tmp / 'aes.bin').write_bytes(aes_payload)
+        result = subprocess.run([node, str(tmp / 'bench.js'), str(tmp / 'xor.bin'), str(tmp / 'aes.bin'), str(repeat)],
+                                capture_output=True, text=True, check=True)
+    times = json.loads(result.stdout)
+    return times['xor'] / 1000, times['aes'] / 1000
+
+def main():
+    if AESGCM is None:
+        print("Error: the cryptography package is required (pip install cryptography)", file=sys.stderr)
+        sys.exit(1)
+    node = shutil.which('node')
+    if not node:
+        print("Warning: node not found, only timing encryption", file=sys.stderr)
+
+    sizes = [float(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES_MB
+    print(f"{'size':>8}  {'encrypt xor':>12}  {'encrypt aes':>12}  {'decrypt xor':>12}  {'decrypt aes':>12}  {'speedup':>8}")
+    for size_mb in sizes:
+        data = os.urandom(int(size_mb * 1024 * 1024))
+        repeat = 3 if size_mb <= 10 else 1
+        xor_time, xor_payload = best_of(lambda: xor_bytes(data, KEY.encode('utf-8')), repeat)
+        aes_time, aes_payload = best_of(lambda: aes_gcm_encrypt(data, KEY, NONCE), repeat)
+        line = f"{size_mb:>6g}MB  {xor_time:>11.3f}s  {aes_time:>11.3f}s"
+        if node:
+            xor_decrypt, aes_decrypt = node_decrypt_times(node, xor_payload, aes_payload, repeat)
+            line += f"  {xor_decrypt:>11.3f}s  {aes_decrypt:>11.3f}s  {xor_decrypt / aes_decrypt:>7.1f}x"
+        print(line)
+
+if __name__ == "__main__":
+    main()
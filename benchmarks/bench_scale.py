@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Scale benchmark for gdrive_sync.py and generate_site.py, run against the
+in-process fake Drive in fake_drive.py instead of the real API.
+For each tree shape and size it times a full sync, then, after
+EDIT_FRACTION of the files changed, a full walk reusing the folder cache
+and an incremental sync, and finally a sharded site build. The cached walk
+must produce the same listing as the incremental sync. A full sync of a
+fresh tree with --workers 1 and then PARALLEL_WORKERS compares API calls
+and wall time; use --latency to see the difference workers make. Each of
+the sync, workers and build steps runs in its own process, and sync RSS
+leaves out the fake tree.
+Needs the packages in requirements.txt.
+Usage: python benchmarks/bench_scale.py [--sizes N ...] [--shapes wide deep many]
+       [--latency S] [--error-rate P] [--json PATH] [--baseline PATH]
+"""
+import argparse
+import hashlib
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / 'scripts'))
+sys.path.insert(0, str(BENCH_DIR))
+from fake_drive import ROOT_FOLDER_ID, SHAPES, FakeDrive, build_tree
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+EDIT_FRACTION = 0.01
+# Compared against a sequential full sync; the workflow's --workers
+PARALLEL_WORKERS = 4
+# How much slower, bigger or hungrier than the baseline a result may be
+DEFAULT_TOLERANCE = 0.25
+# Compared against --baseline; API calls are compared exactly
+COMPARED = ['full_seconds', 'cached_seconds', 'incremental_seconds', 'sync_rss', 'workers1_seconds',
+            f'workers{PARALLEL_WORKERS}_seconds', 'generate_seconds', 'generate_rss', 'output_bytes']
+API_CALLS = ['full_api_calls', 'cached_api_calls', 'incremental_api_calls', 'workers1_api_calls',
+             f'workers{PARALLEL_WORKERS}_api_calls']
+
+def peak_rss():
+    """Peak resident set size of this process, in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def run_sync(args, work_dir):
+    """
+    Full sync, then a cached full walk and an incremental sync after an
+    edit, against a fresh fake; writes files.jsonl and users.json.
+    """
+    import gdrive_sync
+
+    drive = build_tree(FakeDrive(args.latency, args.error_rate, args.retry_after), args.shape, args.files)
+    gdrive_sync.get_gdrive_client = lambda: drive
+    result = {'tree_rss': peak_rss()}
+    state_file = work_dir / 'sync_state.json'
+    cache_file = work_dir / 'folder_cache.json'
+    for step in ('full', 'cached', 'incremental'):
+        if step == 'cached':
+            result['changes'] = drive.edit(EDIT_FRACTION)
+        requests = drive.requests
+        ctx = gdrive_sync.SyncContext(args.max_qps)
+        start = time.perf_counter()
+        # The cached walk leaves the sync state alone, so the incremental
+        # sync after it still has to catch up on the edit
+        index = gdrive_sync.sync_index(ROOT_FOLDER_ID, ctx, state_file=None if step == 'cached' else state_file,
+                                       workers=args.workers, cache_file=cache_file)
+        with open(work_dir / f'{step}.jsonl', 'w', encoding='utf-8') as out:
+            gdrive_sync.write_users_data(index, out, 'jsonl')
+        result[f'{step}_seconds'] = time.perf_counter() - start
+        result[f'{step}_api_calls'] = dict(ctx.api_calls)
+        result[f'{step}_requests'] = drive.requests - requests
+        result[f'{step}_retries'] = ctx.retries['retries']
+    result['sync_rss'] = peak_rss() - result['tree_rss']
+    if (work_dir / 'cached.jsonl').read_bytes() != (work_dir / 'incremental.jsonl').read_bytes():
+        print("Error: the cached full walk and the incremental sync listed different files", file=sys.stderr)
+        sys.exit(1)
+    (work_dir / 'incremental.jsonl').replace(work_dir / 'files.jsonl')
+    result['listing_bytes'] = (work_dir / 'files.jsonl').stat().st_size
+
+    users = {meta['name'].lower(): {'password_hash': hashlib.sha256(meta['name'].encode('utf-8')).hexdigest()}
+             for meta in index['folders'].values() if meta['parent'] == index['users_folder_id']}
+    with open(work_dir / 'users.json', 'w', encoding='utf-8') as f:
+        json.dump(users, f)
+    return result
+
+def run_workers(args, work_dir):
+    """
+    Full sync of a fresh fake with --workers 1, then PARALLEL_WORKERS;
+    both must list the same files.
+    """
+    import gdrive_sync
+
+    result = {}
+    listings = []
+    for workers in (1, PARALLEL_WORKERS):
+        drive = build_tree(FakeDrive(args.latency, args.error_rate, args.retry_after), args.shape, args.files)
+        gdrive_sync.get_gdrive_client = lambda: drive
+        ctx = gdrive_sync.SyncContext(args.max_qps)
+        start = time.perf_counter()
+        index = gdrive_sync.sync_index(ROOT_FOLDER_ID, ctx, workers=workers)
+        result[f'workers{workers}_seconds'] = time.perf_counter() - start
+        result[f'workers{workers}_api_calls'] = dict(ctx.api_calls)
+        with open(work_dir / f'workers{workers}.jsonl', 'w', encoding='utf-8') as out:
+            gdrive_sync.write_users_data(index, out, 'jsonl')
+        listings.append((work_dir / f'workers{workers}.jsonl').read_bytes())
+    if listings[0] != listings[1]:
+        print(f"Error: --workers {PARALLEL_WORKERS} listed different files than --workers 1", file=sys.stderr)
+        sys.exit(1)
+    return result
+
+def run_generate(args, work_dir):
+    """Sharded site build from the listing run_sync wrote."""
+    from generate_site import generate_site
+
+    site_dir = work_dir / 'site'
+    start = time.perf_counter()
+    generate_site(work_dir / 'files.jsonl', work_dir / 'users.json', site_dir, force=True, shard=True)
+    return {
+        'generate_seconds': time.perf_counter() - start,
+        'generate_rss': peak_rss(),
+        'output_bytes': sum(path.stat().st_size for path in site_dir.rglob('*') if path.is_file()),
+    }
+
+STEPS = {'sync': run_sync, 'workers': run_workers, 'generate': run_generate}
+
+def run_step(step, args, shape, files, work_dir):
+    """Run one step in a child process and return its results."""
+    command = [sys.executable, __file__, '--step', step, '--shape', shape, '--files', str(files),
+               '--work-dir', str(work_dir), '--latency', str(args.latency), '--error-rate', str(args.error_rate),
+               '--workers', str(args.workers), '--max-qps', str(args.max_qps)]
+    if args.retry_after is not None:
+        command += ['--retry-after', str(args.retry_after)]
+    log_file = work_dir / f'{step}.log'
+    with open(log_file, 'w', encoding='utf-8') as log:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=log, text=True)
+    if result.returncode != 0:
+        tail = log_file.read_text(encoding='utf-8').splitlines()[-20:]
+        print(f"Error: {step} failed for {shape} {files}:\n" + '\n'.join(tail), file=sys.stderr)
+        sys.exit(1)
+    return json.loads(result.stdout)
+
+def compare(results, baseline, tolerance):
+    """Print regressions against a previous --json run. Returns how many there were."""
+    previous = {(r['shape'], r['files']): r for r in baseline}
+    regressions = 0
+    for r in results:
+        old = previous.get((r['shape'], r['files']))
+        if not old:
+            continue
+        for key in API_CALLS:
+            if key in old and sum(r[key].values()) > sum(old[key].values()):
+                print(f"Regression: {r['shape']} {r['files']}: {key} {sum(old[key].values())} -> "
+                      f"{sum(r[key].values())}", file=sys.stderr)
+                regressions += 1
+        for key in COMPARED:
+            if old.get(key) and r[key] > old[key] * (1 + tolerance):
+                print(f"Regression: {r['shape']} {r['files']}: {key} {old[key]:,.3f} -> {r[key]:,.3f} "
+                      f"(+{r[key] / old[key] - 1:.0%})", file=sys.stderr)
+                regressions += 1
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sync and site generation against a fake Drive.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, metavar='N',
+                        help="numbers of files to benchmark (default: 1k 10k 100k 1M)")
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=list(SHAPES),
+                        help="tree shapes to benchmark (default: all)")
+    parser.add_argument('--latency', type=float, default=0.0, metavar='S',
+                        help="seconds per fake Drive round trip (default: 0)")
+    parser.add_argument('--error-rate', type=float, default=0.0, metavar='P',
+                        help="chance of a 503 per round trip or batch item (default: 0)")
+    parser.add_argument('--retry-after', type=int, default=0, metavar='S',
+                        help="Retry-After sent with fake errors, replacing gdrive_sync's backoff (default: 0)")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="gdrive_sync --workers (default: 1)")
+    parser.add_argument('--max-qps', type=float, default=float('inf'), metavar='N',
+                        help="gdrive_sync --max-qps (default: unlimited, so latency is the only cost)")
+    parser.add_argument('--json', metavar='PATH', help="also write the results here")
+    parser.add_argument('--baseline', metavar='PATH',
+                        help="results of an earlier --json run; exit non-zero on regressions against it")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, metavar='F',
+                        help=f"allowed slowdown or growth against --baseline (default: {DEFAULT_TOLERANCE})")
+    # Used by the child processes each step runs in
+    parser.add_argument('--step', choices=STEPS, help=argparse.SUPPRESS)
+    parser.add_argument('--shape', help=argparse.SUPPRESS)
+    parser.add_argument('--files', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.step:
+        print(json.dumps(STEPS[args.step](args, args.work_dir)))
+        return
+
+    parallel = f'w{PARALLEL_WORKERS}'
+    print(f"{'shape':>5}  {'files':>8}  {'full calls':>10}  {'full':>8}  {'cache calls':>11}  {'cached':>8}  "
+          f"{'incr calls':>10}  {'incr':>7}  {'sync RSS':>8}  {'w1 calls':>8}  {'w1':>8}  {parallel + ' calls':>8}  "
+          f"{parallel:>8}  {'generate':>8}  {'gen RSS':>8}  {'output':>8}")
+    results = []
+    for shape in args.shapes:
+        for files in args.sizes:
+            with tempfile.TemporaryDirectory() as work_dir:
+                work_dir = Path(work_dir)
+                result = {'shape': shape, 'files': files}
+                result.update(run_step('sync', args, shape, files, work_dir))
+                result.update(run_step('workers', args, shape, files, work_dir))
+                result.update(run_step('generate', args, shape, files, work_dir))
+            results.append(result)
+            print(f"{shape:>5}  {files:>8,}  {sum(result['full_api_calls'].values()):>10,}  "
+                  f"{result['full_seconds']:>7.2f}s  {sum(result['cached_api_calls'].values()):>11,}  "
+                  f"{result['cached_seconds']:>7.2f}s  {sum(result['incremental_api_calls'].values()):>10,}  "
+                  f"{result['incremental_seconds']:>6.2f}s  {result['sync_rss'] / 2**20:>6.0f}MB  "
+                  f"{sum(result['workers1_api_calls'].values()):>8,}  {result['workers1_seconds']:>7.2f}s  "
+                  f"{sum(result[f'workers{PARALLEL_WORKERS}_api_calls'].values()):>8,}  "
+                  f"{result[f'workers{PARALLEL_WORKERS}_seconds']:>7.2f}s  "
+                  f"{result['generate_seconds']:>7.2f}s  {result['generate_rss'] / 2**20:>6.0f}MB  "
+                  f"{result['output_bytes'] / 2**20:>6.1f}MB", flush=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Error: {regressions} regressions against {args.baseline}", file=sys.stderr)
+            sys.exit(1)
+        print(f"✓ No regressions against {args.baseline}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
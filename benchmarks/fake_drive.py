@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+In-process fake of the Drive v3 API subset used by gdrive_sync.py:
+files().list, permissions().create, batch requests and the changes feed.
+Serves a generated folder tree with configurable latency and error rate,
+so syncs can be benchmarked without credentials or network access.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+ANYONE_WITH_LINK_ID = 'anyoneWithLink'
+ROOT_FOLDER_ID = 'root'
+USERS_FOLDER_ID = 'users'
+SHAPES = ('wide', 'deep', 'many')
+
+# (extension, mimeType, has content) cycled through for generated files
+FILE_TYPES = [
+    ('jpg', 'image/jpeg', True),
+    ('pdf', 'application/pdf', True),
+    ('mp4', 'video/mp4', True),
+    ('', 'application/vnd.google-apps.document', False),
+    ('txt', 'text/plain', True),
+    ('png', 'image/png', True),
+]
+# Files per folder in the wide shape, and folders per chain in the deep one
+WIDE_FOLDER_SIZE = 1000
+DEEP_CHAIN_DEPTH = 64
+DEEP_FOLDER_SIZE = 200
+# Files per user in the many-users shape
+MANY_USER_SIZE = 100
+BASE_TIME = 1704067200  # 2024-01-01T00:00:00Z
+
+class FakeRequest:
+    """A single API call, executed like a googleapiclient HttpRequest."""
+
+    def __init__(self, drive, method_id, handler):
+        self.methodId = method_id
+        self.drive = drive
+        self.handler = handler
+        # Parses the response body, like googleapiclient's JSON model
+        self.postproc = lambda resp, content: json.loads(content)
+
+    def execute(self):
+        self.drive.round_trip()
+        return self.drive.respond(self)
+
+class FakeBatch:
+    """A batch request: one round trip, then a callback per item."""
+
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        self.requests.append((request_id or str(len(self.requests)), request, callback or self.callback))
+
+    def execute(self):
+        self.drive.round_trip()
+        for request_id, request, callback in self.requests:
+            try:
+                self.drive.maybe_fail()
+                response = self.drive.respond(request)
+            except HttpError as e:
+                callback(request_id, None, e)
+            else:
+                callback(request_id, response, None)
+
+class Resource:
+    """files(), permissions() or changes(): maps method names to handlers."""
+
+    def __init__(self, drive, prefix, methods):
+        self.drive = drive
+        self.prefix = prefix
+        self.methods = methods
+
+    def __getattr__(self, name):
+        if name not in self.methods:
+            raise AttributeError(name)
+        handler = self.methods[name]
+        return lambda **kwargs: FakeRequest(self.drive, f"{self.prefix}.{name}", lambda: handler(**kwargs))
+
+class FakeDrive:
+    """
+    A Drive service holding one generated tree.
+    latency is the seconds each HTTP round trip takes (a batch is one);
+    error_rate is the chance a round trip, or an item in a batch, fails
+    with a 503. retry_after is sent with those errors, so gdrive_sync
+    waits that long instead of its own backoff; None leaves it out.
+    Safe to share between threads, like one client per worker.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=None, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # folder ID -> [name, parent, version]
+        self.folders = {}
+        # file ID -> [name, type index, size, parent, version, public]
+        self.file_meta = {}
+        self.children = {}
+        self.change_log = []
+        self.pages = {}
+        self.next_query = 0
+        # Round trips plus batch items served, failed ones included
+        self.requests = 0
+        self.folders[ROOT_FOLDER_ID] = ['root', None, 0]
+        self.add_folder(USERS_FOLDER_ID, 'users', ROOT_FOLDER_ID)
+
+    # Tree building
+
+    def add_folder(self, folder_id, name, parent):
+        self.folders[folder_id] = [name, parent, 0]
+        self.children.setdefault(parent, []).append(folder_id)
+        self.children.setdefault(folder_id, [])
+
+    def add_file(self, file_id, n, parent):
+        ext, _, has_content = FILE_TYPES[n % len(FILE_TYPES)]
+        name = f"file {n}.{ext}" if ext else f"file {n}"
+        size = 1024 + (n * 7919) % (50 * 1024 * 1024) if has_content else 0
+        self.file_meta[file_id] = [name, n % len(FILE_TYPES), size, parent, 0, False]
+        self.children[parent].append(file_id)
+
+    # Items as Drive returns them
+
+    def folder_item(self, folder_id):
+        name, parent, version = self.folders[folder_id]
+        return {
+            'id': folder_id,
+            'name': name,
+            'mimeType': FOLDER_MIME_TYPE,
+            'modifiedTime': iso_time(version),
+            'parents': [parent],
+            'permissionIds': [],
+        }
+
+    def file_item(self, file_id):
+        name, type_index, size, parent, version, public = self.file_meta[file_id]
+        _, mime_type, has_content = FILE_TYPES[type_index]
+        item = {
+            'id': file_id,
+            'name': name,
+            'mimeType': mime_type,
+            'modifiedTime': iso_time(version),
+            'parents': [parent],
+            'permissionIds': [ANYONE_WITH_LINK_ID] if public else [],
+        }
+        if has_content:
+            item['size'] = str(size)
+            item['md5Checksum'] = hashlib.md5(f"{file_id}:{version}".encode('ascii')).hexdigest()
+        if mime_type.startswith('image/'):
+            item['thumbnailLink'] = f"https://lh3.googleusercontent.com/fake/{file_id}=s220"
+        return item
+
+    def item(self, item_id):
+        return self.folder_item(item_id) if item_id in self.folders else self.file_item(item_id)
+
+    # Requests
+
+    def round_trip(self):
+        """Wait out the latency and maybe fail, like one HTTP exchange."""
+        if self.latency:
+            time.sleep(self.latency)
+        self.maybe_fail()
+
+    def maybe_fail(self):
+        with self.lock:
+            self.requests += 1
+            failed = self.error_rate and self.random.random() < self.error_rate
+        if failed:
+            headers = {'status': '503'}
+            if self.retry_after is not None:
+                headers['retry-after'] = str(self.retry_after)
+            raise HttpError(httplib2.Response(headers), b'{"error": {"code": 503, "message": "Backend Error"}}')
+
+    def respond(self, request):
+        """Run request and hand its JSON body to the request's postproc."""
+        with self.lock:
+            response = request.handler()
+        return request.postproc(None, json.dumps(response).encode('utf-8'))
+
+    def files(self):
+        return Resource(self, 'drive.files', {'list': self.list_files})
+
+    def permissions(self):
+        return Resource(self, 'drive.permissions', {'create': self.create_permission})
+
+    def changes(self):
+        return Resource(self, 'drive.changes', {'getStartPageToken': self.get_start_page_token,
+                                                'list': self.list_changes})
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def list_files(self, q='', pageSize=100, pageToken=None, **_):
+        """Answer the three query forms gdrive_sync sends, one page at a time."""
+        if pageToken:
+            query, offset = pageToken.split(':')
+            items = self.pages[query]
+            offset = int(offset)
+        else:
+            parents = re.findall(r"'([^']+)' in parents", q)
+            name = re.search(r"name='([^']*)'", q)
+            folders_only = f"mimeType='{FOLDER_MIME_TYPE}'" in q
+            if parents:
+                ids = [i for parent in parents for i in self.children.get(parent, [])]
+            else:
+                ids = [f for f in self.folders if f != ROOT_FOLDER_ID]
+            if folders_only:
+                ids = [i for i in ids if i in self.folders]
+            if name:
+                ids = [i for i in ids if self.item_name(i) == name.group(1)]
+            items = ids
+            query = str(self.next_query)
+            self.next_query += 1
+            offset = 0
+        page = [self.item(i) for i in items[offset:offset + pageSize]]
+        result = {'files': page}
+        if offset + pageSize < len(items):
+            self.pages[query] = items
+            result['nextPageToken'] = f"{query}:{offset + pageSize}"
+        else:
+            self.pages.pop(query, None)
+        return result
+
+    def item_name(self, item_id):
+        return (self.folders.get(item_id) or self.file_meta[item_id])[0]
+
+    def create_permission(self, fileId, body=None, **_):
+        # Not put in the changes feed, so incremental syncs only see edit()s
+        self.file_meta[fileId][5] = True
+        return {'id': ANYONE_WITH_LINK_ID}
+
+    def get_start_page_token(self):
+        return {'startPageToken': str(len(self.change_log))}
+
+    def list_changes(self, pageToken, pageSize=100, **_):
+        start = int(pageToken)
+        end = min(start + pageSize, len(self.change_log))
+        result = {'changes': [self.change(file_id) for file_id in self.change_log[start:end]]}
+        if end < len(self.change_log):
+            result['nextPageToken'] = str(end)
+        else:
+            result['newStartPageToken'] = str(end)
+        return result
+
+    def change(self, item_id):
+        if item_id in self.folders or item_id in self.file_meta:
+            return {'fileId': item_id, 'removed': False, 'file': self.item(item_id)}
+        return {'fileId': item_id, 'removed': True}
+
+    # Edits between syncs, recorded in the changes feed
+
+    def edit(self, fraction, seed=1):
+        """
+        Modify, add and remove about fraction of the files in equal parts.
+        Adding or removing a file bumps its folder's modifiedTime; modifying
+        one only changes the file's own. Returns the number of changes recorded.
+        """
+        rng = random.Random(seed)
+        with self.lock:
+            file_ids = list(self.file_meta)
+            n = max(3, int(len(file_ids) * fraction)) // 3
+            picked = rng.sample(file_ids, min(len(file_ids), 2 * n))
+            for file_id in picked[:n]:
+                self.file_meta[file_id][4] += 1
+                self.change_log.append(file_id)
+            for file_id in picked[n:]:
+                meta = self.file_meta.pop(file_id)
+                self.children[meta[3]].remove(file_id)
+                self.folders[meta[3]][2] += 1
+                self.change_log.append(file_id)
+            parents = [meta[3] for meta in (self.file_meta[f] for f in picked[:n])]
+            for k, parent in enumerate(parents):
+                file_id = f"new{len(self.change_log):08d}"
+                self.add_file(file_id, len(self.file_meta) + k, parent)
+                self.folders[parent][2] += 1
+                self.change_log.append(file_id)
+            return len(picked) + len(parents)
+
+def iso_time(version):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(BASE_TIME + version * 3600))
+
+def build_tree(drive, shape, total_files):
+    """
+    Fill drive with total_files files under users/, laid out as:
+    wide - 10 users, folders of WIDE_FOLDER_SIZE files one level down;
+    deep - 10 users, chains of DEEP_CHAIN_DEPTH nested folders;
+    many - one user per MANY_USER_SIZE files, half in a subfolder.
+    """
+    if shape == 'many':
+        users = max(1, total_files // MANY_USER_SIZE)
+    else:
+        users = min(10, total_files) or 1
+    next_file = 0
+    next_folder = 0
+
+    def new_folder(name, parent):
+        nonlocal next_folder
+        folder_id = f"d{next_folder:08d}"
+        next_folder += 1
+        drive.add_folder(folder_id, name, parent)
+        return folder_id
+
+    for u in range(users):
+        user_files = total_files // users + (1 if u < total_files % users else 0)
+        user_root = new_folder(f"user{u:05d}", USERS_FOLDER_ID)
+        if shape == 'wide':
+            folders = [new_folder(f"folder {k}", user_root)
+                       for k in range(max(1, -(-user_files // WIDE_FOLDER_SIZE)))]
+        elif shape == 'deep':
+            folders = []
+            for chain in range(max(1, -(-user_files // (DEEP_CHAIN_DEPTH * DEEP_FOLDER_SIZE)))):
+                parent = user_root
+                for depth in range(DEEP_CHAIN_DEPTH):
+                    parent = new_folder(f"level {depth}" if depth else f"chain {chain}", parent)
+                    folders.append(parent)
+        else:
+            folders = [user_root, new_folder('photos', user_root)]
+        for k in range(user_files):
+            drive.add_file(f"f{next_file:08d}", next_file, folders[k % len(folders)])
+            next_file += 1
+    return drive
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Download Drive thumbnails for image files and pack them into sprite sheets.
+Reads the sync output (which carries each file's thumbnailLink) and writes
+WebP sheets of THUMB_SIZE px tiles to <output_dir>/thumbs/, one or more per
+user folder, plus a manifest mapping file IDs to sheet positions for
+generate_site.py --thumbnails. Tiles are cached by file ID together with
+the file's md5Checksum (or modifiedTime), so only new or changed images are
+downloaded again.
+Requires Pillow and GOOGLE_DRIVE_CREDENTIALS env var with service account JSON.
+"""
+import argparse
+import hashlib
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+from gdrive_sync import get_credentials, load_json_file, save_json_file
+from generate_site import iter_users_data
+
+THUMBNAILS_VERSION = 1
+# Tiles are shown at 28px, so 56px stays sharp on high-density screens
+THUMB_SIZE = 56
+# Sheets are SHEET_COLUMNS x SHEET_COLUMNS tiles
+SHEET_COLUMNS = 8
+SHEET_DIR = 'thumbs'
+# Matches the .thumb placeholder background in the page
+SHEET_BACKGROUND = (240, 240, 240)
+
+def thumbnail_key(f):
+    """What a cached tile was made from; a different key means the image changed."""
+    return f.get('md5Checksum') or f.get('modifiedTime') or ''
+
+def load_tile_cache(cache_dir):
+    """Load the tile cache index, or an empty one."""
+    cache = load_json_file(cache_dir / 'index.json', THUMBNAILS_VERSION, 'thumbnail cache')
+    return cache or {'version': THUMBNAILS_VERSION, 'files': {}}
+
+def make_tile(image_bytes):
+    """Crop and scale an image to a square THUMB_SIZE tile."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        return ImageOps.fit(img, (THUMB_SIZE, THUMB_SIZE), Image.LANCZOS)
+
+def fetch_tiles(files, cache_dir, workers=4):
+    """
+    Download and cache tiles for files, a list of file records.
+    Returns the IDs of files whose tile couldn't be fetched.
+    """
+    from google_auth_httplib2 import AuthorizedHttp
+
+    credentials = get_credentials()
+    local = threading.local()
+
+    def fetch(f):
+        # httplib2 connections aren't thread-safe, so each worker has its own
+        if not hasattr(local, 'http'):
+            local.http = AuthorizedHttp(credentials)
+        try:
+            response, content = local.http.request(f['thumbnailLink'])
+            if response.status != 200:
+                raise ValueError(f"HTTP {response.status}")
+            make_tile(content).save(cache_dir / f"{f['id']}.webp", format='WEBP', quality=85)
+            return True
+        except Exception as e:
+            print(f"  Warning: Could not fetch thumbnail for {f['name']}: {e}", file=sys.stderr)
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        fetched = list(pool.map(fetch, files))
+    return {f['id'] for f, ok in zip(files, fetched) if not ok}
+
+def build_sheet(file_ids, cache_dir, path):
+    """Paste cached tiles into one sheet, in order, and save it as WebP."""
+    side = SHEET_COLUMNS * THUMB_SIZE
+    sheet = Image.new('RGB', (side, side), SHEET_BACKGROUND)
+    for pos, file_id in enumerate(file_ids):
+        with Image.open(cache_dir / f"{file_id}.webp") as tile:
+            sheet.paste(tile, ((pos % SHEET_COLUMNS) * THUMB_SIZE, (pos // SHEET_COLUMNS) * THUMB_SIZE))
+    sheet.save(path, format='WEBP', quality=80, method=6)
+
+def build_thumbnails(users_data_file, output_dir, cache_dir, manifest_file, workers=4):
+    """
+    Bring the tile cache, sheets and manifest up to date with the sync output.
+    Sheets are named by a hash of the tiles they hold, so unchanged sheets
+    are neither rebuilt nor renamed, and a sheet name can't be guessed
+    without knowing the file IDs in it.
+    """
+    output_dir = Path(output_dir)
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    sheet_dir = output_dir / SHEET_DIR
+    sheet_dir.mkdir(parents=True, exist_ok=True)
+    cache = load_tile_cache(cache_dir)
+
+    # Group each user's images by folder and note which tiles are missing or outdated
+    groups = []
+    stale = []
+    for username, files in iter_users_data(users_data_file):
+        folders = {}
+        for f in sorted(files, key=lambda f: (f.get('folder', ''), f.get('name', ''))):
+            if f.get('category') != 'image' or not f.get('thumbnailLink'):
+                continue
+            folders.setdefault(f.get('folder', ''), []).append(f)
+            cached = cache['files'].get(f['id'])
+            if not cached or cached['key'] != thumbnail_key(f) or not (cache_dir / f"{f['id']}.webp").exists():
+                stale.append(f)
+        groups.extend(folders.values())
+
+    failed = set()
+    if stale:
+        print(f"  Fetching {len(stale)} thumbnails", file=sys.stderr)
+        failed = fetch_tiles(stale, cache_dir, workers)
+        for f in stale:
+            if f['id'] not in failed:
+                cache['files'][f['id']] = {'key': thumbnail_key(f)}
+        if failed:
+            print(f"  Warning: {len(failed)} thumbnails failed; those files keep Drive's thumbnail URL", file=sys.stderr)
+
+    # Pack tiles into sheets, SHEET_COLUMNS² per sheet
+    per_sheet = SHEET_COLUMNS * SHEET_COLUMNS
+    positions = {}
+    sheets = set()
+    built = 0
+    listed = set()
+    for files in groups:
+        files = [f for f in files if f['id'] not in failed and f['id'] in cache['files']]
+        listed.update(f['id'] for f in files)
+        for start in range(0, len(files), per_sheet):
+            chunk = files[start:start + per_sheet]
+            digest = hashlib.sha256('\n'.join(f"{f['id']}:{thumbnail_key(f)}" for f in chunk).encode('utf-8'))
+            name = f"{SHEET_DIR}/{digest.hexdigest()[:32]}.webp"
+            if not (output_dir / name).exists():
+                build_sheet([f['id'] for f in chunk], cache_dir, output_dir / name)
+                built += 1
+            sheets.add(name)
+            for pos, f in enumerate(chunk):
+                positions[f['id']] = [name, pos]
+
+    # Drop sheets and tiles nothing refers to anymore
+    for path in sheet_dir.glob('*.webp'):
+        if f"{SHEET_DIR}/{path.name}" not in sheets:
+            path.unlink()
+    for file_id in list(cache['files']):
+        if file_id not in listed:
+            del cache['files'][file_id]
+            (cache_dir / f"{file_id}.webp").unlink(missing_ok=True)
+    save_json_file(cache_dir / 'index.json', cache)
+
+    manifest = {'version': THUMBNAILS_VERSION, 'columns': SHEET_COLUMNS, 'files': positions}
+    save_json_file(manifest_file, manifest)
+    print(f"✓ {len(positions)} thumbnails in {len(sheets)} sheets ({built} rebuilt)", file=sys.stderr)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build thumbnail sprite sheets from Drive thumbnails.")
+    parser.add_argument('users_data', help="synced file listing (gdrive_files.json or .jsonl)")
+    parser.add_argument('output_dir', help="site directory; sheets go to its thumbs/ folder")
+    parser.add_argument('--cache', default='data/thumb_cache', metavar='DIR',
+                        help="where downloaded tiles are kept between runs (default: data/thumb_cache)")
+    parser.add_argument('--manifest', default='data/thumbnails.json', metavar='PATH',
+                        help="sheet positions for generate_site.py --thumbnails (default: data/thumbnails.json)")
+    parser.add_argument('--workers', type=int, default=4, metavar='N',
+                        help="download up to N thumbnails in parallel (default: 4)")
+    args = parser.parse_args()
+
+    if Image is None:
+        print("Error: Pillow is required to build thumbnails (pip install Pillow)", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        build_thumbnails(args.users_data, args.output_dir, args.cache, args.manifest, workers=args.workers)
+    except Exception as e:
+        print(f"Fatal error: {e}", file=sys.stderr)
+        sys.exit(1)
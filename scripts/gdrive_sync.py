@@ -3,15 +3,192 @@
 Sync files from Google Drive and fetch metadata.
 Requires GOOGLE_DRIVE_CREDENTIALS env var with service account JSON.
 """
+import argparse
 import json
 import os
+import random
 import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
-def get_gdrive_client():
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+METRICS_VERSION = 1
+
+# Stay under Drive's default quota of 12,000 queries per minute per user
+DEFAULT_MAX_QPS = 100
+REQUEST_MAX_ATTEMPTS = 6
+MAX_BACKOFF = 64
+
+class TokenBucket:
     """
-    Initialize Google Drive API client.
+    Rate limiter shared by every thread issuing Drive requests.
+    The rate halves whenever Drive reports a rate limit and creeps back
+    up to max_rate as requests succeed.
+    """
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = max_rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        """Take cost tokens, sleeping until they are available. Returns the seconds slept."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going into debt lets a batch costing more than a full
+            # bucket through, while later callers wait it off.
+            self.tokens -= cost
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(1, self.rate / 2)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+class SyncContext:
+    """
+    What one sync shares between its requests and worker threads: the
+    request throttle, the folder cache and the statistics it reports.
+    """
+
+    def __init__(self, max_qps=DEFAULT_MAX_QPS):
+        self.throttle = TokenBucket(max_qps)
+        # Saved folder listings keyed by folder ID, set by sync_index
+        self.folder_cache = None
+        # Cached folders whose listing changed since the cache was saved, set by full_sync
+        self.stale_folders = None
+        # Drive API requests issued, by method
+        self.api_calls = Counter()
+        # Sharing outcomes: granted, skipped, failed
+        self.grants = Counter()
+        # Request retries and seconds spent waiting: retries, throttled, backoff
+        self.retries = Counter()
+        # Folder listings reused from or missing in folder_cache: hits, misses
+        self.cache_stats = Counter()
+        # Request latencies by method: Counter of LATENCY_BUCKETS upper bounds, plus 'seconds'
+        self.latency = {}
+        # Response body bytes received, by method
+        self.bytes_received = Counter()
+        # Seconds spent crawling each subtree, by its root folder ID
+        self.crawl_times = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, counter, key, amount=1):
+        """Increment one of the statistics; safe to call from worker threads."""
+        with self.lock:
+            counter[key] += amount
+
+    def record_latency(self, method, start):
+        """Add a request that started at start (time.monotonic()) to the latency histograms."""
+        seconds = time.monotonic() - start
+        bucket = next(bound for bound in LATENCY_BUCKETS if seconds <= bound)
+        with self.lock:
+            histogram = self.latency.setdefault(method, Counter())
+            histogram[bucket] += 1
+            histogram['seconds'] += seconds
+
+def count_received(ctx, request):
+    """
+    Count the response bytes of request in ctx.bytes_received.
+    Works for requests sent in a batch too, whose responses are parsed by
+    the same postproc hook. Returns request.
+    """
+    postproc = getattr(request, 'postproc', None)
+    if postproc is None:
+        return request
+    method = getattr(request, 'methodId', 'batch')
+
+    def counting_postproc(resp, content):
+        ctx.count(ctx.bytes_received, method, len(content or b''))
+        return postproc(resp, content)
+
+    request.postproc = counting_postproc
+    return request
+
+def is_retryable(error):
+    """True for Drive errors worth retrying: rate limits, server and network errors."""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or status >= 500 or is_rate_limited(error)
+
+def is_rate_limited(error):
+    """True for Drive's 403/429 rate limit errors."""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    content = error.content.decode('utf-8', 'replace') if isinstance(error.content, bytes) else str(error.content)
+    return error.resp.status == 403 and ('rateLimitExceeded' in content or 'userRateLimitExceeded' in content)
+
+def retry_delay(error, attempt):
+    """Seconds to wait before retrying: Retry-After if given, else jittered exponential backoff."""
+    retry_after = error.resp.get('retry-after') if isinstance(error, HttpError) else None
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+    return random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+
+def execute(ctx, request, cost=1):
+    """
+    Execute a Drive API request, counting it in ctx.api_calls.
+    Requests are throttled by ctx.throttle; cost is the number of calls the
+    request counts for against the quota (one per item in a batch).
+    Rate limit, server and network errors are retried with backoff.
+    """
+    # Batch requests have no methodId of their own
+    method = getattr(request, 'methodId', 'batch')
+    count_received(ctx, request)
+    for attempt in range(REQUEST_MAX_ATTEMPTS):
+        waited = ctx.throttle.acquire(cost)
+        if waited:
+            ctx.count(ctx.retries, 'throttled', waited)
+        ctx.count(ctx.api_calls, method)
+        start = time.monotonic()
+        try:
+            response = request.execute()
+        except Exception as e:
+            ctx.record_latency(method, start)
+            if not is_retryable(e) or attempt == REQUEST_MAX_ATTEMPTS - 1:
+                raise
+            if is_rate_limited(e):
+                ctx.throttle.slow_down()
+            delay = retry_delay(e, attempt)
+            print(f"  Retrying {method} in {delay:.1f}s: {e}", file=sys.stderr)
+            ctx.count(ctx.retries, 'retries')
+            ctx.count(ctx.retries, 'backoff', delay)
+            time.sleep(delay)
+        else:
+            ctx.record_latency(method, start)
+            ctx.throttle.speed_up()
+            return response
+
+def format_api_calls(api_calls):
+    """Summarise api_calls as 'total (method: n, ...)'."""
+    by_method = ', '.join(f"{method.replace('drive.', '')}: {n}" for method, n in sorted(api_calls.items()))
+    return f"{sum(api_calls.values())} ({by_method})" if api_calls else "0"
+
+def get_credentials():
+    """
+    Load service account credentials for Drive.
     Expects GOOGLE_DRIVE_CREDENTIALS env var with service account JSON.
     """
     if "GOOGLE_DRIVE_CREDENTIALS" not in os.environ:
@@ -31,7 +208,14 @@ def get_gdrive_client():
     except Exception as e:
         print(f"Error: Failed to create credentials: {e}", file=sys.stderr)
         raise
-    
+    return credentials
+
+def get_gdrive_client():
+    """
+    Initialize Google Drive API client.
+    Expects GOOGLE_DRIVE_CREDENTIALS env var with service account JSON.
+    """
+    credentials = get_credentials()
     try:
         service = build('drive', 'v3', credentials=credentials)
         print("✓ Google Drive API client initialized", file=sys.stderr)
@@ -40,16 +224,16 @@ def get_gdrive_client():
         print(f"Error: Failed to build Drive service: {e}", file=sys.stderr)
         raise
 
-def find_folder_by_name(service, parent_id, folder_name):
+def find_folder_by_name(service, ctx, parent_id, folder_name):
     """Find a folder by name in Google Drive."""
     try:
         query = f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and '{parent_id}' in parents and trashed=false"
-        results = service.files().list(
+        results = execute(ctx, service.files().list(
             q=query,
             spaces='drive',
             fields='files(id, name)',
             pageSize=1
-        ).execute()
+        ))
         
         files = results.get('files', [])
         if files:
@@ -60,35 +244,42 @@ def find_folder_by_name(service, parent_id, folder_name):
         print(f"Error searching for folder '{folder_name}': {e}", file=sys.stderr)
         raise
 
-def list_files_in_folder(service, folder_id):
+def list_children(service, ctx, parent_ids):
+    """
+    List the direct children of one or more Google Drive folders.
+    Yields items as each page arrives, following nextPageToken.
+    """
+    parents_query = ' or '.join(f"'{parent_id}' in parents" for parent_id in parent_ids)
+    query = f"({parents_query}) and trashed=false"
+    page_token = None
+    while True:
+        try:
+            results = execute(ctx, service.files().list(
+                q=query,
+                spaces='drive',
+                fields='nextPageToken, files(id, name, mimeType, size, modifiedTime, md5Checksum, thumbnailLink, parents, permissionIds, webViewLink)',
+                pageSize=1000,
+                pageToken=page_token
+            ))
+        except Exception as e:
+            print(f"Error listing files in folders {', '.join(parent_ids)}: {e}", file=sys.stderr)
+            raise
+
+        yield from results.get('files', [])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def list_files_in_folder(service, ctx, folder_id):
     """List all files in a Google Drive folder (non-recursive)."""
-    try:
-        query = f"'{folder_id}' in parents and trashed=false"
-        results = service.files().list(
-            q=query,
-            spaces='drive',
-            fields='files(id, name, mimeType, size, webViewLink)',
-            pageSize=1000
-        ).execute()
-        
-        return results.get('files', [])
-    except Exception as e:
-        print(f"Error listing files in folder {folder_id}: {e}", file=sys.stderr)
-        raise
+    return list_children(service, ctx, [folder_id])
 
-def get_shareable_link(service, file_id, category='other'):
+def get_shareable_link(service, ctx, file_id, category='other'):
     """Get a shareable link for a file."""
     try:
         # Make the file publicly accessible
-        try:
-            service.permissions().create(
-                fileId=file_id,
-                body={'role': 'reader', 'type': 'anyone'},
-                fields='id'
-            ).execute()
+        if make_public(service, ctx, file_id):
             print(f"✓ Made file {file_id} public", file=sys.stderr)
-        except Exception as e:
-            print(f"Note: Could not set permissions for {file_id}: {e}", file=sys.stderr)
         
         # Return links that work without Google login
         if category == 'image':
@@ -149,97 +340,666 @@ def format_bytes(size):
         size /= 1024.0
     return f"{size:.1f} PB"
 
-def sync_users_from_gdrive(root_folder_id):
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+# Permission ID Drive assigns to "anyone with the link" access
+ANYONE_WITH_LINK_ID = 'anyoneWithLink'
+SYNC_STATE_VERSION = 2
+FOLDER_CACHE_VERSION = 3
+
+# Folders listed per files().list query; keeps the query well under Drive's length limit
+PARENT_BATCH_SIZE = 50
+# Drive accepts at most 100 calls per batch request
+GRANT_BATCH_SIZE = 100
+GRANT_MAX_ATTEMPTS = 5
+
+def is_supported_type(mime_type):
+    """Skip Google Apps types we can't preview or export (sites, maps, etc.)."""
+    return not mime_type.startswith('application/vnd.google-apps.') or mime_type in GOOGLE_NATIVE_TYPES
+
+def make_public(service, ctx, file_id):
+    """Grant 'anyone with the link' read access to a file. Returns True on success."""
+    try:
+        execute(ctx, service.permissions().create(
+            fileId=file_id,
+            body={'role': 'reader', 'type': 'anyone'},
+            fields='id'
+        ))
+        return True
+    except Exception as e:
+        print(f"Note: Could not set permissions for {file_id}: {e}", file=sys.stderr)
+        return False
+
+def share_files(service, ctx, index, file_ids):
     """
-    Fetch user folders and files from Google Drive.
-    Returns: {username: [files]}
+    Make indexed files public, skipping those already known to be.
+    Grants go out as HTTP batches of up to GRANT_BATCH_SIZE; items that
+    fail with a retryable error are re-sent with exponential backoff.
+    """
+    pending = []
+    for file_id in file_ids:
+        if index['files'][file_id].get('public'):
+            ctx.count(ctx.grants, 'skipped')
+        else:
+            pending.append(file_id)
+
+    for attempt in range(GRANT_MAX_ATTEMPTS):
+        if not pending:
+            return
+        if attempt:
+            delay = 2 ** (attempt - 1)
+            print(f"  Retrying {len(pending)} permission grants in {delay}s", file=sys.stderr)
+            ctx.count(ctx.retries, 'retries', len(pending))
+            ctx.count(ctx.retries, 'backoff', delay)
+            time.sleep(delay)
+        last_attempt = attempt == GRANT_MAX_ATTEMPTS - 1
+        retry = []
+
+        def on_response(file_id, response, exception):
+            if exception is None:
+                index['files'][file_id]['public'] = True
+                ctx.count(ctx.grants, 'granted')
+            elif is_retryable(exception) and not last_attempt:
+                if is_rate_limited(exception):
+                    ctx.throttle.slow_down()
+                retry.append(file_id)
+            else:
+                print(f"Note: Could not set permissions for {file_id}: {exception}", file=sys.stderr)
+                ctx.count(ctx.grants, 'failed')
+
+        for start in range(0, len(pending), GRANT_BATCH_SIZE):
+            chunk = pending[start:start + GRANT_BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=on_response)
+            for file_id in chunk:
+                batch.add(count_received(ctx, service.permissions().create(
+                    fileId=file_id,
+                    body={'role': 'reader', 'type': 'anyone'},
+                    fields='id'
+                )), request_id=file_id)
+            try:
+                execute(ctx, batch, cost=len(chunk))
+            except Exception as e:
+                # The batch itself failed (e.g. a dropped connection), so
+                # none of its callbacks ran; resend every item in it.
+                print(f"Note: Permission batch failed: {e}", file=sys.stderr)
+                for file_id in chunk:
+                    on_response(file_id, None, e)
+        pending = retry
+
+def index_item(index, item, parent_id):
+    """Record a Drive item in the sync index."""
+    item_id = item['id']
+    if item['mimeType'] == FOLDER_MIME_TYPE:
+        index['files'].pop(item_id, None)
+        index['folders'][item_id] = {'name': item['name'], 'parent': parent_id}
+        return
+    index['folders'].pop(item_id, None)
+    if 'permissionIds' in item:
+        public = ANYONE_WITH_LINK_ID in item['permissionIds']
+    else:
+        public = index['files'].get(item_id, {}).get('public', False)
+    index['files'][item_id] = {
+        'name': item['name'],
+        'parent': parent_id,
+        'mimeType': item.get('mimeType', ''),
+        'size': item.get('size', 0),
+        'modifiedTime': item.get('modifiedTime'),
+        'md5Checksum': item.get('md5Checksum'),
+        'thumbnailLink': item.get('thumbnailLink'),
+        'public': public
+    }
+
+def stale_cached_folders(service, ctx, cache):
+    """
+    Find the cached folders whose listing changed since the cache was saved.
+    Returns None if Drive no longer accepts the cache's changes token.
     """
     try:
-        service = get_gdrive_client()
-    except Exception as e:
-        print(f"Error: Failed to initialize Google Drive client: {e}", file=sys.stderr)
-        raise
-    
+        changes, _ = list_changes(service, ctx, cache['page_token'])
+    except HttpError as e:
+        print(f"Note: Folder cache token rejected ({e.resp.status})", file=sys.stderr)
+        return None
+    # A change touches the listing the item was cached in and, if it moved
+    # or was added, the listing of its current parent.
+    changed = {change['fileId'] for change in changes}
+    stale = {f for f, children in cache['folders'].items() if any(child['id'] in changed for child in children)}
+    for change in changes:
+        stale.update((change.get('file') or {}).get('parents') or [])
+    return stale
+
+def cached_children(ctx, folder_id):
+    """Return a folder's cached listing if nothing in it changed, else None."""
+    if ctx.folder_cache is None or ctx.stale_folders is None:
+        return None
+    children = ctx.folder_cache['folders'].get(folder_id)
+    if children is None or folder_id in ctx.stale_folders:
+        ctx.count(ctx.cache_stats, 'misses')
+        return None
+    ctx.count(ctx.cache_stats, 'hits')
+    return children
+
+def build_folder_cache(index):
+    """Build the folder cache from the final index, as of its changes token."""
+    cache = {'version': FOLDER_CACHE_VERSION, 'page_token': index['page_token']}
+    cache['folders'] = {folder_id: [] for folder_id in index['folders']}
+    for folder_id, meta in index['folders'].items():
+        if meta['parent'] in cache['folders']:
+            cache['folders'][meta['parent']].append({'id': folder_id, 'name': meta['name'], 'mimeType': FOLDER_MIME_TYPE})
+    for file_id, meta in index['files'].items():
+        if meta['parent'] in cache['folders']:
+            item = {field: value for field, value in meta.items() if field not in ('parent', 'public') and value is not None}
+            item['id'] = file_id
+            item['permissionIds'] = [ANYONE_WITH_LINK_ID] if meta.get('public') else []
+            cache['folders'][meta['parent']].append(item)
+    return cache
+
+def crawl_folders(service, ctx, index, folder_ids, workers=1):
+    """
+    Index everything below folder_ids, breadth-first and PARENT_BATCH_SIZE folders per query.
+    With workers > 1, up to that many of a level's queries run at once.
+    Returns the IDs of supported files found, for share_files.
+    """
+    start = time.monotonic()
+    found_files = []
+    level = list(folder_ids)
+    depth = 1
+    # httplib2 isn't thread-safe, so each worker thread builds its own Drive client
+    local = threading.local()
+
+    def list_batch(parent_ids):
+        if not hasattr(local, 'service'):
+            local.service = get_gdrive_client()
+        return list(list_children(local.service, ctx, parent_ids))
+
+    def listings(batches):
+        """Yield (parent_ids, children) for each batch, in order."""
+        if workers <= 1 or len(batches) <= 1:
+            for parent_ids in batches:
+                yield parent_ids, list_children(service, ctx, parent_ids)
+            return
+        # workers batches at a time, so only that many listings are held at once
+        for i in range(0, len(batches), workers):
+            group = batches[i:i + workers]
+            yield from zip(group, pool.map(list_batch, group))
+
+    def add_child(item, parent_id):
+        index_item(index, item, parent_id)
+        if item['mimeType'] == FOLDER_MIME_TYPE:
+            next_level.append(item['id'])
+        elif not is_supported_type(item['mimeType']):
+            print(f"  Skipping unsupported type: {item['name']} ({item['mimeType']})", file=sys.stderr)
+        else:
+            found_files.append(item['id'])
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while level:
+            next_level = []
+            to_list = []
+            for folder_id in level:
+                children = cached_children(ctx, folder_id)
+                if children is None:
+                    to_list.append(folder_id)
+                    continue
+                for item in children:
+                    add_child(item, folder_id)
+
+            # Children are indexed in batch order, so the index and the
+            # queries sent are the same whatever the number of workers
+            batches = [to_list[i:i + PARENT_BATCH_SIZE] for i in range(0, len(to_list), PARENT_BATCH_SIZE)]
+            for parent_ids, children in listings(batches):
+                for item in children:
+                    add_child(item, next(p for p in item.get('parents', []) if p in parent_ids))
+
+            if next_level:
+                print(f"  ✓ Entering {len(next_level)} subfolders at depth {depth}", file=sys.stderr)
+            level = next_level
+            depth += 1
+
+    # One query lists several subtrees, so only a lone subtree can be timed
+    if len(folder_ids) == 1:
+        ctx.count(ctx.crawl_times, folder_ids[0], time.monotonic() - start)
+    return found_files
+
+def prune_index(index):
+    """Drop folders and files that are no longer reachable from the users folder."""
+    folders = index['folders']
+    users_folder_id = index['users_folder_id']
+    reachable = {}
+
+    def is_reachable(folder_id):
+        path = []
+        seen = set()
+        while folder_id not in reachable:
+            if folder_id == users_folder_id:
+                result = True
+                break
+            meta = folders.get(folder_id)
+            if meta is None or folder_id in seen:
+                result = False
+                break
+            path.append(folder_id)
+            seen.add(folder_id)
+            folder_id = meta['parent']
+        else:
+            result = reachable[folder_id]
+        for f in path:
+            reachable[f] = result
+        return result
+
+    for folder_id in list(folders):
+        if not is_reachable(folder_id):
+            del folders[folder_id]
+    for file_id in [f for f, meta in index['files'].items() if meta['parent'] not in folders]:
+        del index['files'][file_id]
+
+def iter_users_data(index):
+    """
+    Derive the sync output from the index one user at a time.
+    Yields (username, files) in username order, files sorted by folder path, then name.
+    """
+    folders = index['folders']
+    users_folder_id = index['users_folder_id']
+    locations = {}
+
+    def locate(folder_id):
+        """Return (username, path relative to the user folder) for a folder."""
+        if folder_id not in locations:
+            meta = folders[folder_id]
+            if meta['parent'] == users_folder_id:
+                locations[folder_id] = (meta['name'].lower(), '')
+            else:
+                username, parent_path = locate(meta['parent'])
+                path = f"{parent_path}/{meta['name']}" if parent_path else meta['name']
+                locations[folder_id] = (username, path)
+        return locations[folder_id]
+
+    user_file_ids = {}
+    for folder_id, meta in folders.items():
+        if meta['parent'] == users_folder_id:
+            user_file_ids[meta['name'].lower()] = []
+    for file_id, meta in index['files'].items():
+        if is_supported_type(meta.get('mimeType', '')):
+            user_file_ids[locate(meta['parent'])[0]].append(file_id)
+
+    for username in sorted(user_file_ids):
+        files = []
+        for file_id in user_file_ids.pop(username):
+            meta = index['files'][file_id]
+            mime_type = meta.get('mimeType', '')
+            name = meta['name']
+            ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+            # 'size' is for display; 'bytes' and the fields below are raw values
+            record = {
+                'name': name,
+                'id': file_id,
+                'size': format_bytes(meta.get('size', 0)),
+                'bytes': int(meta.get('size') or 0),
+                'ext': ext,
+                'category': get_file_category(ext, mime_type),
+                'folder': locate(meta['parent'])[1]
+            }
+            # Google Docs have no checksum, and not every file has a thumbnail
+            for field in ('modifiedTime', 'md5Checksum', 'thumbnailLink'):
+                if meta.get(field):
+                    record[field] = meta[field]
+            files.append(record)
+        files.sort(key=lambda f: (f.get('folder', ''), f['name']))
+        yield username, files
+
+def build_users_data(index):
+    """Derive the {username: [files]} output from the sync index."""
+    return dict(iter_users_data(index))
+
+def write_users_data(index, out, output_format='json', compact=False):
+    """
+    Write the sync output to out, one user at a time.
+    'json' writes {username: [files]} (indented unless compact); 'jsonl'
+    writes one file record per line, tagged with its 'user' and grouped
+    by user. Returns the number of users written.
+    """
+    indent = None if compact else 2
+    separators = (',', ':') if compact else None
+    users = 0
+    if output_format != 'jsonl':
+        out.write('{')
+    for username, files in iter_users_data(index):
+        if output_format == 'jsonl':
+            for entry in files:
+                out.write(json.dumps({'user': username, **entry}, separators=(',', ':')) + '\n')
+        else:
+            # Each user's chunk is what json.dumps would produce for that key
+            chunk = json.dumps({username: files}, indent=indent, separators=separators)
+            out.write((',' if users else '') + chunk[1:-1].rstrip('\n'))
+        print(f"  ✓ Found {len(files)} files for {username}", file=sys.stderr)
+        users += 1
+    if output_format != 'jsonl':
+        out.write('\n}\n' if users and indent else '}\n')
+    return users
+
+def get_start_page_token(service, ctx):
+    """Get the Drive changes token marking 'now'."""
+    return execute(ctx, service.changes().getStartPageToken())['startPageToken']
+
+def list_changes(service, ctx, page_token):
+    """
+    Fetch every change since page_token.
+    Returns (changes, new_start_page_token).
+    """
+    changes = []
+    while True:
+        results = execute(ctx, service.changes().list(
+            pageToken=page_token,
+            spaces='drive',
+            includeRemoved=True,
+            fields='nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, size, modifiedTime, md5Checksum, thumbnailLink, parents, permissionIds, trashed))',
+            pageSize=1000
+        ))
+        changes.extend(results.get('changes', []))
+        if 'newStartPageToken' in results:
+            return changes, results['newStartPageToken']
+        page_token = results['nextPageToken']
+
+def apply_changes(service, ctx, index, changes, workers=1):
+    """Apply Drive changes to the sync index. Returns the number of changes applied."""
+    known_folders = set(index['folders'])
+    changed_files = []
+    for change in changes:
+        item = change.get('file')
+        file_id = change.get('fileId')
+        if file_id == index['users_folder_id']:
+            continue
+        if change.get('removed') or not item or item.get('trashed'):
+            index['folders'].pop(file_id, None)
+            index['files'].pop(file_id, None)
+            continue
+        parents = item.get('parents') or [None]
+        index_item(index, item, parents[0])
+        if item['mimeType'] != FOLDER_MIME_TYPE:
+            changed_files.append(file_id)
+
+    prune_index(index)
+
+    # A folder moved in from outside the tree brings its existing contents
+    # with it, and those don't show up as changes - crawl it directly.
+    new_folders = {f for f in index['folders'] if f not in known_folders}
+    moved_in = [f for f in new_folders if index['folders'][f]['parent'] not in new_folders]
+    if moved_in:
+        print(f"  ✓ Crawling {len(moved_in)} new folders", file=sys.stderr)
+        changed_files.extend(crawl_folders(service, ctx, index, moved_in, workers))
+
+    # Files whose grant failed on an earlier run are still private and
+    # won't show up as changes, so they're retried as well
+    unshared = [f for f, meta in index['files'].items() if not meta.get('public')]
+    share_files(service, ctx, index, [
+        f for f in dict.fromkeys(changed_files + unshared)
+        if f in index['files'] and is_supported_type(index['files'][f]['mimeType'])
+    ])
+    return len(changes)
+
+def load_json_file(path, version, label):
+    """Load a versioned JSON file, or None if missing or unusable."""
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError as e:
+        print(f"Warning: Ignoring invalid {label} {path}: {e}", file=sys.stderr)
+        return None
+    if data.get('version') != version:
+        print(f"Warning: Ignoring {label} {path} from another version", file=sys.stderr)
+        return None
+    return data
+
+def save_json_file(path, data):
+    """Atomically write a compact JSON file."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_file, path)
+
+def load_sync_state(state_file):
+    """Load the saved sync index, or None if missing or unusable."""
+    return load_json_file(state_file, SYNC_STATE_VERSION, 'sync state')
+
+def save_sync_state(state_file, state):
+    """Atomically write the sync index."""
+    save_json_file(state_file, state)
+
+def load_folder_cache(cache_file):
+    """Load the folder listing cache, or an empty one."""
+    cache = load_json_file(cache_file, FOLDER_CACHE_VERSION, 'folder cache')
+    return cache or {'version': FOLDER_CACHE_VERSION, 'folders': {}}
+
+def full_sync(service, ctx, root_folder_id, workers=1):
+    """Walk every user folder and build a fresh sync index."""
     print(f"✓ Looking for users folder in {root_folder_id}", file=sys.stderr)
-    
-    # Find the users folder
-    users_folder_id = find_folder_by_name(service, root_folder_id, 'users')
+
+    # Take the changes token before walking so edits made mid-walk are
+    # picked up by the next incremental run.
+    page_token = get_start_page_token(service, ctx)
+
+    users_folder_id = find_folder_by_name(service, ctx, root_folder_id, 'users')
     if not users_folder_id:
         raise ValueError(f"Could not find 'users' folder in parent {root_folder_id}")
-    
-    # List all user folders
+
+    index = {
+        'version': SYNC_STATE_VERSION,
+        'root_folder_id': root_folder_id,
+        'users_folder_id': users_folder_id,
+        'page_token': page_token,
+        'folders': {},
+        'files': {}
+    }
+
+    if ctx.folder_cache and ctx.folder_cache['folders']:
+        ctx.stale_folders = stale_cached_folders(service, ctx, ctx.folder_cache)
+        if ctx.stale_folders is not None:
+            print(f"✓ Folder cache: {len(ctx.stale_folders)} folders changed since it was saved", file=sys.stderr)
+
     print(f"✓ Syncing user folders...", file=sys.stderr)
-    user_folders = list_files_in_folder(service, users_folder_id)
-    
-    users_data = {}
-    
-    for user_folder in user_folders:
-        if user_folder['mimeType'] != 'application/vnd.google-apps.folder':
+    user_folder_ids = []
+    for user_folder in list_files_in_folder(service, ctx, users_folder_id):
+        if user_folder['mimeType'] != FOLDER_MIME_TYPE:
             continue
-        
-        username = user_folder['name'].lower()
-        print(f"✓ Processing user folder: {username}", file=sys.stderr)
-        
-        # Recursively collect files from user folder and subfolders
-        user_files = []
-        
-        def collect_files(folder_id, folder_path=''):
-            """Recursively list files, tracking folder path."""
-            items = list_files_in_folder(service, folder_id)
-            for item in items:
-                if item['mimeType'] == 'application/vnd.google-apps.folder':
-                    subfolder_name = item['name']
-                    sub_path = f"{folder_path}/{subfolder_name}" if folder_path else subfolder_name
-                    print(f"  ✓ Entering subfolder: {sub_path}", file=sys.stderr)
-                    collect_files(item['id'], sub_path)
-                else:
-                    mime_type = item.get('mimeType', '')
-                    # Skip unsupported Google Apps types (sites, maps, etc.)
-                    if mime_type.startswith('application/vnd.google-apps.') and mime_type not in GOOGLE_NATIVE_TYPES:
-                        print(f"  Skipping unsupported type: {item['name']} ({mime_type})", file=sys.stderr)
-                        continue
-                    size = int(item.get('size', 0))
-                    name = item['name']
-                    ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
-                    category = get_file_category(ext, mime_type)
-                    
-                    # Make file publicly accessible
-                    try:
-                        service.permissions().create(
-                            fileId=item['id'],
-                            body={'role': 'reader', 'type': 'anyone'},
-                            fields='id'
-                        ).execute()
-                    except Exception as e:
-                        print(f"Note: Could not set permissions for {item['id']}: {e}", file=sys.stderr)
-                    
-                    user_files.append({
-                        'name': name,
-                        'id': item['id'],
-                        'size': format_bytes(size),
-                        'ext': ext,
-                        'category': category,
-                        'folder': folder_path
-                    })
-        
-        collect_files(user_folder['id'])
-        
-        users_data[username] = sorted(user_files, key=lambda f: (f.get('folder', ''), f['name']))
-        print(f"  ✓ Found {len(user_files)} files for {username}", file=sys.stderr)
-    
+        print(f"✓ Processing user folder: {user_folder['name'].lower()}", file=sys.stderr)
+        index_item(index, user_folder, users_folder_id)
+        user_folder_ids.append(user_folder['id'])
+    found_files = crawl_folders(service, ctx, index, user_folder_ids, workers)
+    share_files(service, ctx, index, found_files)
+    return index
+
+def incremental_sync(service, ctx, root_folder_id, state, workers=1):
+    """
+    Bring a saved sync index up to date with the Drive changes feed.
+    Returns None if the saved token can't be used and a full walk is needed.
+    """
+    if state.get('root_folder_id') != root_folder_id:
+        print("Note: Root folder changed since last sync", file=sys.stderr)
+        return None
+    try:
+        changes, new_token = list_changes(service, ctx, state['page_token'])
+    except HttpError as e:
+        print(f"Note: Saved changes token rejected ({e.resp.status})", file=sys.stderr)
+        return None
+    print(f"✓ Applying {len(changes)} changes since last sync", file=sys.stderr)
+    apply_changes(service, ctx, state, changes, workers)
+    state['page_token'] = new_token
+    return state
+
+def sync_index(root_folder_id, ctx=None, state_file=None, workers=1, cache_file=None):
+    """
+    Bring the sync index up to date with Google Drive, incrementally if state_file holds a usable index.
+    Requests are throttled and counted in ctx, a new SyncContext if None. Returns the index.
+    """
+    try:
+        service = get_gdrive_client()
+    except Exception as e:
+        print(f"Error: Failed to initialize Google Drive client: {e}", file=sys.stderr)
+        raise
+
+    ctx = ctx or SyncContext()
+    index = None
+    if state_file:
+        state = load_sync_state(state_file)
+        if state:
+            index = incremental_sync(service, ctx, root_folder_id, state, workers)
+        if index is None:
+            print("✓ Falling back to a full sync", file=sys.stderr)
+    if index is None:
+        # Only a full walk reads the cache; it's rebuilt from the index below either way
+        ctx.folder_cache = load_folder_cache(cache_file) if cache_file else None
+        index = full_sync(service, ctx, root_folder_id, workers)
+        ctx.folder_cache = None
+
+    if state_file:
+        save_sync_state(state_file, index)
+        print(f"✓ Saved sync state to {state_file}", file=sys.stderr)
+
+    if cache_file:
+        save_json_file(cache_file, build_folder_cache(index))
+        print(f"✓ Folder cache: {ctx.cache_stats['hits']} hits, {ctx.cache_stats['misses']} misses", file=sys.stderr)
+
+    grants = ctx.grants
+    print(f"✓ Sharing: {grants['granted']} granted, {grants['skipped']} skipped (already public), {grants['failed']} failed", file=sys.stderr)
+    print(f"✓ Drive API calls: {format_api_calls(ctx.api_calls)}", file=sys.stderr)
+    retries = ctx.retries
+    print(f"✓ Retries: {retries['retries']}, {retries['backoff']:.1f}s backing off, {retries['throttled']:.1f}s throttled", file=sys.stderr)
+    return index
+
+def folder_owners(index):
+    """Map each indexed folder to the username whose folder it is in."""
+    folders = index['folders']
+    users_folder_id = index['users_folder_id']
+    owners = {}
+    for folder_id in folders:
+        path = []
+        while folder_id not in owners:
+            meta = folders.get(folder_id)
+            if meta is None:
+                owner = None
+                break
+            path.append(folder_id)
+            if meta['parent'] == users_folder_id:
+                owner = meta['name'].lower()
+                break
+            folder_id = meta['parent']
+        else:
+            owner = owners[folder_id]
+        for f in path:
+            owners[f] = owner
+    return owners
+
+def build_metrics(ctx, index, seconds):
+    """
+    Summarise the last sync for --metrics-out: request counts, latency
+    histograms and bytes by Drive method, retries, sharing and cache
+    statistics, and per-user folder and file counts and crawl times.
+    index may be None if the sync failed.
+    """
+    latency = {}
+    for method, histogram in sorted(ctx.latency.items()):
+        latency[method] = {
+            'count': sum(histogram[bound] for bound in LATENCY_BUCKETS),
+            'seconds': round(histogram['seconds'], 3),
+            'histogram': {str(bound): histogram[bound] for bound in LATENCY_BUCKETS}
+        }
+    metrics = {
+        'version': METRICS_VERSION,
+        'seconds': round(seconds, 3),
+        'api_calls': dict(sorted(ctx.api_calls.items())),
+        'latency': latency,
+        'bytes_received': dict(sorted(ctx.bytes_received.items())),
+        'retries': {key: round(value, 3) for key, value in sorted(ctx.retries.items())},
+        'grants': dict(sorted(ctx.grants.items())),
+        'folder_cache': dict(sorted(ctx.cache_stats.items())),
+    }
+    if index is None:
+        return metrics
+
+    owners = folder_owners(index)
+    users = {}
+    for folder_id, owner in owners.items():
+        if owner is not None:
+            user = users.setdefault(owner, {'folders': 0, 'files': 0})
+            if index['folders'][folder_id]['parent'] != index['users_folder_id']:
+                user['folders'] += 1
+    for meta in index['files'].values():
+        owner = owners.get(meta['parent'])
+        if owner is not None and is_supported_type(meta.get('mimeType', '')):
+            users[owner]['files'] += 1
+    for folder_id, crawl_seconds in ctx.crawl_times.items():
+        owner = owners.get(folder_id)
+        if owner is not None:
+            users[owner]['crawl_seconds'] = round(users[owner].get('crawl_seconds', 0) + crawl_seconds, 3)
+    metrics['users'] = dict(sorted(users.items()))
+    return metrics
+
+def sync_users_from_gdrive(root_folder_id, **options):
+    """
+    Fetch user folders and files from Google Drive.
+    Accepts the same options as sync_index.
+    Returns: {username: [files]}
+    """
+    users_data = build_users_data(sync_index(root_folder_id, **options))
+    for username, files in users_data.items():
+        print(f"  ✓ Found {len(files)} files for {username}", file=sys.stderr)
     print(f"✓ Sync complete: {len(users_data)} users", file=sys.stderr)
     return users_data
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync user files from Google Drive and print them as JSON.")
+    parser.add_argument('--state', metavar='PATH',
+                        help="sync state file; enables incremental sync via the Drive changes feed")
+    parser.add_argument('--cache', metavar='PATH',
+                        help="folder listing cache; full walks only re-list folders that changed since the last run")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="send up to N folder listing queries at once (default: 1)")
+    parser.add_argument('--max-qps', type=float, default=DEFAULT_MAX_QPS, metavar='N',
+                        help=f"cap on Drive requests per second across all workers (default: {DEFAULT_MAX_QPS})")
+    parser.add_argument('--output', metavar='PATH',
+                        help="write the file listing here instead of to stdout")
+    parser.add_argument('--format', choices=['json', 'jsonl'], default='json',
+                        help="json: {user: [files]} (default); jsonl: one file record per line")
+    parser.add_argument('--compact', action='store_true',
+                        help="don't indent json output")
+    parser.add_argument('--metrics-out', metavar='PATH',
+                        help="write request, latency and per-user metrics for this run here as JSON")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_qps <= 0:
+        parser.error("--max-qps must be positive")
+
     root_folder_id = os.environ.get('GDRIVE_ROOT_FOLDER_ID')
     if not root_folder_id:
         print("Error: GDRIVE_ROOT_FOLDER_ID environment variable not set", file=sys.stderr)
         sys.exit(1)
     
+    started = time.monotonic()
+    ctx = SyncContext(args.max_qps)
+    index = None
+    error = None
     try:
-        users_data = sync_users_from_gdrive(root_folder_id)
-        # Output JSON to stdout
-        print(json.dumps(users_data, indent=2))
+        index = sync_index(root_folder_id, ctx, state_file=args.state, workers=args.workers, cache_file=args.cache)
+        # Stream the listing to stdout (or --output) one user at a time
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as out:
+                users = write_users_data(index, out, args.format, args.compact)
+        else:
+            users = write_users_data(index, sys.stdout, args.format, args.compact)
+        print(f"✓ Sync complete: {users} users", file=sys.stderr)
     except Exception as e:
+        error = str(e)
         print(f"Fatal error: {e}", file=sys.stderr)
         sys.exit(1)
+    finally:
+        # Written for failed runs too, which are the ones worth looking at
+        if args.metrics_out:
+            metrics = build_metrics(ctx, index, time.monotonic() - started)
+            if error:
+                metrics['error'] = error
+            save_json_file(args.metrics_out, metrics)
+            print(f"✓ Wrote metrics to {args.metrics_out}", file=sys.stderr)
@@ -2,11 +2,86 @@
 """
 Generate static HTML site from user data and file listings.
 """
+import argparse
 import json
 import sys
 import base64
+import hashlib
+import re
+import textwrap
+import time
+import unicodedata
+import zlib
+from collections import Counter
+from contextlib import contextmanager
 from pathlib import Path
 
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+# Changes whenever the generator itself does, so edits to the template
+# invalidate previous builds without a manual version bump.
+GENERATOR_VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:16]
+MANIFEST_NAME = '.build-manifest.json'
+CIPHERS = ('xor', 'aes-gcm')
+# First byte of an AES-GCM payload. XOR payloads have no header: their first
+# byte is a zlib header or JSON bracket XORed with a hex digit of the key,
+# which is never below 0x19, so lower values are free for format versions.
+PAYLOAD_AES_GCM = 0x01
+
+# Build stages timed for --metrics-out, in the order a payload goes through them
+STAGES = ('load', 'sort', 'serialize', 'compress', 'encrypt', 'encode', 'write')
+METRICS_VERSION = 1
+# Seconds spent in each of STAGES during the current build
+STAGE_TIMES = Counter()
+# Byte sizes of each user's payload during the current build
+PAYLOAD_SIZES = {}
+
+@contextmanager
+def timed(stage):
+    """Add the time spent in the block to STAGE_TIMES[stage]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_TIMES[stage] += time.perf_counter() - start
+
+def timed_iter(iterable, stage):
+    """Iterate, adding the time spent producing each item to STAGE_TIMES[stage]."""
+    iterator = iter(iterable)
+    while True:
+        with timed(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def xor_bytes(data, key):
+    """
+    XOR data with a repeating key.
+    Works on the whole buffer as one big integer, so the loop runs in C
+    instead of once per byte in Python.
+    """
+    if not data:
+        return b''
+    repeats, remainder = divmod(len(data), len(key))
+    keystream = key * repeats + key[:remainder]
+    mixed = int.from_bytes(data, 'big') ^ int.from_bytes(keystream, 'big')
+    return mixed.to_bytes(len(data), 'big')
+
+def aes_gcm_encrypt(data, key, nonce):
+    """
+    Encrypt data with AES-256-GCM, keyed by the SHA-256 of key (the password
+    hash). Returns the PAYLOAD_AES_GCM byte, the 12-byte nonce, then the
+    ciphertext and tag; the format byte is authenticated with the data.
+    """
+    header = bytes([PAYLOAD_AES_GCM])
+    aes_key = hashlib.sha256(key.encode('utf-8')).digest()
+    return header + nonce + AESGCM(aes_key).encrypt(nonce, data, header)
+
 def get_file_icon(category):
     """Get emoji icon for file category."""
     icons = {
@@ -89,35 +164,269 @@ def render_file_card(file):
         </div>
         '''
 
-def generate_index_html(users_data, users_config):
-    """Generate the main index.html with login and file views."""
+SIZE_UNITS = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
+
+def parse_size(size):
+    """
+    Turn a display size from the sync output ("1.5 MB") back into bytes,
+    for listings from syncs that predate the raw 'bytes' field.
+    The page formats it again the same way gdrive_sync.format_bytes does,
+    which reproduces the original string. Unparseable sizes pass through.
+    """
+    if isinstance(size, (int, float)):
+        return size
+    try:
+        value, unit = str(size).split()
+        return round(float(value) * 1024 ** SIZE_UNITS.index(unit))
+    except ValueError:
+        return size
+
+def build_folder_tree(folders):
+    """
+    Folder hierarchy for a sorted list of folder paths, which must include
+    every ancestor and '' (the root). Returns parallel lists: each folder's
+    parent index (-1 for the root) and its subfolders' indices by name.
+    """
+    folder_index = {path: i for i, path in enumerate(folders)}
+    parents = []
+    children = [[] for _ in folders]
+    for i, path in enumerate(folders):
+        parent = folder_index[path.rpartition('/')[0]] if path else -1
+        parents.append(parent)
+        if parent >= 0:
+            children[parent].append(i)
+    for subfolders in children:
+        subfolders.sort(key=lambda i: folders[i].rpartition('/')[2])
+    return parents, children
+
+def search_tokens(text):
+    """Lowercased words of text with accents stripped; the page splits queries the same way."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.category(c).startswith('M'))
+    return re.findall(r'[^\W_]+', text)
+
+def build_search_index(folders, names):
+    """Word index over file and folder names for the page's search box."""
+    postings = {}
+    for i, name in enumerate(names):
+        for token in set(search_tokens(name)):
+            postings.setdefault(token, ([], []))[0].append(i)
+    for i, path in enumerate(folders):
+        for token in set(search_tokens(path.rpartition('/')[2])):
+            postings.setdefault(token, ([], []))[1].append(i)
+    # Sorted the way JavaScript compares strings, so the page can binary
+    # search for the words starting with a prefix
+    tokens = sorted(postings, key=lambda t: t.encode('utf-16-be'))
+    # Ascending indices stored as gaps, which compress far better
+    gaps = lambda indices: [b - a for a, b in zip([0] + indices, indices)]
+    return {
+        'tokens': tokens,
+        'files': [gaps(postings[t][0]) for t in tokens],
+        'folders': [gaps(postings[t][1]) for t in tokens],
+    }
+
+def encode_file_list(files, thumbnails=None):
+    """Pack a file list sorted by folder into the columnar payload the page decodes."""
+    paths = {''}
+    for f in files:
+        folder = f.get('folder', '')
+        while folder not in paths:
+            paths.add(folder)
+            folder = folder.rpartition('/')[0]
+    folders = sorted(paths)
+    folder_index = {path: i for i, path in enumerate(folders)}
+    parents, children = build_folder_tree(folders)
+    first = [0] * len(folders)
+    counts = [0] * len(folders)
+    cats, cat_index = [], {}
+    columns = {'name': [], 'id': [], 'size': [], 'cat': [], 'folder': []}
+    for i, f in enumerate(files):
+        folder = folder_index[f.get('folder', '')]
+        if not counts[folder]:
+            first[folder] = i
+        counts[folder] += 1
+        category = f.get('category', 'other')
+        if category not in cat_index:
+            cat_index[category] = len(cats)
+            cats.append(category)
+        columns['name'].append(f.get('name', ''))
+        columns['id'].append(f.get('id', ''))
+        columns['size'].append(f['bytes'] if 'bytes' in f else parse_size(f.get('size', 0)))
+        columns['cat'].append(cat_index[category])
+        columns['folder'].append(folder)
+    # Children sort after their parent, so totals roll up in one reverse pass
+    totals = list(counts)
+    for i in range(len(folders) - 1, 0, -1):
+        totals[parents[i]] += totals[i]
+    tree = {'parent': parents, 'children': children, 'first': first, 'count': counts, 'total': totals}
+    search = build_search_index(folders, columns['name'])
+    # Format 4: 'folders' and 'cats' are lookup tables; 'name', 'id', 'size',
+    # 'cat' and 'folder' have an entry per file. 'tree' is indexed like
+    # 'folders': parent, subfolders, the files directly inside ('first',
+    # 'count'; contiguous since files are sorted by folder) and the recursive
+    # 'total'. 'search' is build_search_index's word index. With thumbnails
+    # (a build_thumbnails.py manifest), 'thumb' is each file's tile as sheet
+    # index * sheetColumns² + position, or -1, with the sheets in 'sheets'.
+    payload = {'v': 4, 'folders': folders, 'tree': tree, 'search': search, 'cats': cats, **columns}
+    if thumbnails:
+        per_sheet = thumbnails['columns'] ** 2
+        sheets, sheet_index = [], {}
+        thumbs = []
+        for file_id in columns['id']:
+            sheet, pos = thumbnails['files'].get(file_id, (None, -1))
+            if sheet is None:
+                thumbs.append(-1)
+                continue
+            if sheet not in sheet_index:
+                sheet_index[sheet] = len(sheets)
+                sheets.append(sheet)
+            thumbs.append(sheet_index[sheet] * per_sheet + pos)
+        if sheets:
+            payload.update({'sheets': sheets, 'sheetColumns': thumbnails['columns'], 'thumb': thumbs})
+    return payload
+
+def shard_id(username, key):
+    """Opaque file name for a user's payload shard; the page derives it the same way after login."""
+    return hashlib.sha256(f"{key}:{username}".encode('utf-8')).hexdigest()[:32]
+
+def build_user_payloads(users_data, user_hashes, payload_cache, shard_dir=None, compress=True, thumbnails=None,
+                        cipher='xor', embedded=None):
+    """
+    Encrypt each user's file list, reusing the payloads payload_cache shows are unchanged.
+    Returns {username: base64 payload}, or {} after writing each user's shard to shard_dir.
+    """
+    mode = ('shard' if shard_dir else 'inline') + ('+deflate' if compress else '')
+    if cipher == 'aes-gcm':
+        mode += '+aes-gcm'
+    if isinstance(users_data, dict):
+        users_data = users_data.items()
+    embedded = embedded or {}
+    user_files_encrypted = {}
+    usernames = set()
+    rebuilt = 0
+    for username, files in users_data:
+        usernames.add(username)
+        # Create file data for each user (sorted by folder, type, then name)
+        with timed('sort'):
+            if isinstance(files, list):
+                sorted_files = sorted(files, key=lambda f: (f.get('folder', ''), f.get('category', 'other'), f.get('name', '')))
+            else:
+                sorted_files = []
+        with timed('serialize'):
+            plaintext = json.dumps(encode_file_list(sorted_files, thumbnails), separators=(',', ':'))
+            key = user_hashes.get(username, '')
+            digest = hashlib.sha256(f"{GENERATOR_VERSION}\0{mode}\0{key}\0{plaintext}".encode('utf-8')).hexdigest()
+        cached = payload_cache.get(username)
+
+        if shard_dir:
+            if not key:
+                # Users without a password can't log in, so get no shard
+                payload_cache.pop(username, None)
+                continue
+            shard_name = shard_id(username, key) + '.bin'
+            if cached and cached['digest'] == digest and (shard_dir / shard_name).exists():
+                PAYLOAD_SIZES[username] = {'payload': (shard_dir / shard_name).stat().st_size, 'rebuilt': False}
+                continue
+        elif cached and cached['digest'] == digest and username in embedded:
+            user_files_encrypted[username] = embedded[username]
+            PAYLOAD_SIZES[username] = {'payload': len(embedded[username]), 'rebuilt': False}
+            continue
+
+        with timed('serialize'):
+            plain_bytes = plaintext.encode('utf-8')
+        # Encrypted data doesn't compress, so this is the only point where it can
+        with timed('compress'):
+            packed = zlib.compress(plain_bytes, 9) if compress else plain_bytes
+        # Encrypt the (compressed) JSON with the password hash
+        with timed('encrypt'):
+            if not key:
+                encrypted = b''
+            elif cipher == 'aes-gcm':
+                # The nonce comes from the payload digest, so rebuilding a payload
+                # gives the same bytes and different payloads never share a nonce
+                encrypted = aes_gcm_encrypt(packed, key, bytes.fromhex(digest)[:12])
+            else:
+                encrypted = xor_bytes(packed, key.encode('utf-8'))
+        if shard_dir:
+            with timed('write'):
+                shard_dir.mkdir(parents=True, exist_ok=True)
+                with open(shard_dir / shard_name, 'wb') as f:
+                    f.write(encrypted)
+            payload_cache[username] = {'digest': digest, 'shard': shard_name}
+            sent = len(encrypted)
+        else:
+            with timed('encode'):
+                user_files_encrypted[username] = base64.b64encode(encrypted).decode('ascii')
+            payload_cache[username] = {'digest': digest}
+            sent = len(user_files_encrypted[username])
+        PAYLOAD_SIZES[username] = {'json': len(plain_bytes), 'packed': len(packed), 'payload': sent, 'rebuilt': True}
+        print(f"  ✓ {username}: {len(plain_bytes):,} B JSON -> {len(packed):,} B "
+              f"{'compressed' if compress else 'uncompressed'} -> {sent:,} B payload", file=sys.stderr)
+        rebuilt += 1
+
+    for username in list(payload_cache):
+        if username not in usernames:
+            del payload_cache[username]
+    print(f"✓ Rebuilt {rebuilt} of {len(usernames)} user payloads", file=sys.stderr)
+    return user_files_encrypted
+
+def load_embedded_payloads(index_path, payload_cache):
+    """
+    Read the user payloads embedded in a previously generated index.html.
+    Only payloads the page lists at the version payload_cache expects are
+    returned, as {username: base64 payload}.
+    """
+    found = {}
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                name, _, value = line.strip().partition(' = ')
+                if name in ('const USER_FILES_ENC', 'const PAYLOAD_VERSIONS'):
+                    found[name] = json.loads(value.rstrip(';'))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    payloads = found.get('const USER_FILES_ENC', {})
+    versions = found.get('const PAYLOAD_VERSIONS', {})
+    return {username: payload for username, payload in payloads.items()
+            if username in payload_cache and versions.get(username) == payload_cache[username]['digest'][:16]}
+
+def remove_stale_shards(shard_dir, payload_cache):
+    """Delete payload shards no longer referenced by any user."""
+    if not shard_dir.is_dir():
+        return
+    keep = {entry.get('shard') for entry in payload_cache.values()}
+    for path in shard_dir.glob('*.bin'):
+        if path.name not in keep:
+            path.unlink()
+            print(f"✓ Removed stale shard {path.name}", file=sys.stderr)
+
+def generate_index_html(users_data, users_config, payload_cache=None, shard_dir=None, compress=True, thumbnails=None,
+                        cipher='xor', embedded=None):
+    """
+    Generate the main index.html with login and file views.
+    users_data is a {username: [files]} dict or an iterable of
+    (username, files) pairs such as iter_users_data returns.
+    With shard_dir, user payloads are written there as separate files and
+    fetched by the page after login instead of being embedded in it.
+    See build_user_payloads for payload_cache, compress, thumbnails, cipher and embedded.
+    """
     
     # Create password hash mapping for frontend
     user_hashes = {}
     for username, config in users_config.items():
         user_hashes[username] = config.get('password_hash', '')
     
-    # Create file data for each user (sorted by type then name)
-    # Then XOR-encrypt each user's file list with their password hash
-    user_files_encrypted = {}
-    for username, files in users_data.items():
-        if isinstance(files, list):
-            sorted_files = sorted(files, key=lambda f: (f.get('folder', ''), f.get('category', 'other'), f.get('name', '')))
-        else:
-            sorted_files = []
-        plaintext = json.dumps(sorted_files)
-        key = user_hashes.get(username, '')
-        if key:
-            # XOR encrypt the JSON string with the password hash
-            key_bytes = key.encode('utf-8')
-            plain_bytes = plaintext.encode('utf-8')
-            encrypted = bytes([plain_bytes[i] ^ key_bytes[i % len(key_bytes)] for i in range(len(plain_bytes))])
-            user_files_encrypted[username] = base64.b64encode(encrypted).decode('ascii')
-        else:
-            user_files_encrypted[username] = ''
+    if payload_cache is None:
+        payload_cache = {}
+    user_files_encrypted = build_user_payloads(users_data, user_hashes, payload_cache, shard_dir, compress, thumbnails,
+                                               cipher, embedded)
     
     user_hashes_json = json.dumps(user_hashes)
     user_files_json = json.dumps(user_files_encrypted)
+    # Changes whenever a user's payload does; the page keys its stored copy by it
+    payload_versions_json = json.dumps({username: entry['digest'][:16] for username, entry in payload_cache.items()},
+                                       sort_keys=True)
+    empty_table_json = json.dumps(encode_file_list([]), separators=(',', ':'))
     
     # CSS as a separate string to avoid f-string hash issues
     css = """        * {
@@ -232,6 +541,10 @@ def generate_index_html(users_data, users_config):
             display: block;
         }
 
+        .search-box {
+            margin-bottom: 24px;
+        }
+
         .user-header {
             display: flex;
             justify-content: space-between;
@@ -395,6 +708,16 @@ def generate_index_html(users_data, users_config):
             width: 260px;
         }
 
+        .file-row .col-icon span.thumb {
+            display: inline-block;
+            background-repeat: no-repeat;
+        }
+
+        .file-spacer td {
+            padding: 0;
+            border: 0;
+        }
+
         .action-btn {
             display: inline-block;
             padding: 5px 12px;
@@ -863,6 +1186,7 @@ def generate_index_html(users_data, users_config):
                 <button class="logout-btn" onclick="logout()">logout</button>
             </div>
             
+            <input type="text" class="search-box" id="searchBox" placeholder="search files and folders" autocomplete="off" oninput="onSearch(this.value)">
             <div class="files-list" id="filesGrid"></div>
         </div>
 
@@ -898,14 +1222,36 @@ def generate_index_html(users_data, users_config):
     <script>
         const USER_HASHES = {user_hashes_json};
         const USER_FILES_ENC = {user_files_json};
-
-        function xorDecrypt(b64, key) {{
-            const raw = atob(b64);
-            let out = '';
-            for (let i = 0; i < raw.length; i++) {{
-                out += String.fromCharCode(raw.charCodeAt(i) ^ key.charCodeAt(i % key.length));
+        const PAYLOAD_VERSIONS = {payload_versions_json};
+        const SHARDED = {'true' if shard_dir else 'false'};
+        const COMPRESSED = {'true' if compress else 'false'};
+
+{PAYLOAD_DECODER_JS}
+        async function decodeUserFiles(source, key) {{
+            // Decode in a worker so a big payload doesn't freeze the page;
+            // fall back to this thread where workers aren't available
+            if (typeof Worker !== 'undefined' && location.protocol !== 'file:') {{
+                try {{
+                    return await new Promise((resolve, reject) => {{
+                        const worker = new Worker('{DECRYPT_WORKER_NAME}');
+                        worker.onmessage = event => {{
+                            worker.terminate();
+                            if (event.data.error) reject(new Error(event.data.error));
+                            else resolve(event.data);
+                        }};
+                        worker.onerror = event => {{
+                            worker.terminate();
+                            reject(new Error(event.message || 'worker failed'));
+                        }};
+                        worker.postMessage({{source, key, compressed: COMPRESSED}});
+                    }});
+                }} catch (e) {{
+                    console.warn('Decoding files on the main thread:', e.message);
+                }}
             }}
-            return out;
+            const result = await loadPayload(source, key, COMPRESSED);
+            result.timings.thread = 'main';
+            return result;
         }}
 
         function fileIcon(cat) {{
@@ -924,7 +1270,212 @@ def generate_index_html(users_data, users_config):
             return icons[cat] || icons.other;
         }}
 
-        let currentFiles = [];
+        // Decrypted payloads are columnar (see encode_file_list); row objects
+        // are only built, once each, for files that are actually shown.
+        let fileTable = null;
+        let fileRows = [];
+        let folderLookup = new Map();
+
+        function searchTokens(text) {{
+            // Same words as search_tokens in generate_site.py
+            return text.toLowerCase().normalize('NFKD').replace(/\\p{{M}}/gu, '').match(/[\\p{{L}}\\p{{N}}]+/gu) || [];
+        }}
+
+        function searchFiles(query) {{
+            // Every query word has to start a word in the name of the file
+            // or folder, or of a folder above it
+            const index = fileTable.search;
+            const tree = fileTable.tree;
+            let files = null;
+            let folders = null;
+            for (const word of new Set(searchTokens(query))) {{
+                const wordFiles = new Set();
+                const wordFolders = new Set();
+                // Tokens are sorted, so those starting with word are one run
+                let lo = 0, hi = index.tokens.length;
+                while (lo < hi) {{
+                    const mid = (lo + hi) >> 1;
+                    if (index.tokens[mid] < word) lo = mid + 1; else hi = mid;
+                }}
+                for (let t = lo; t < index.tokens.length && index.tokens[t].startsWith(word); t++) {{
+                    let i = 0, fi = 0;
+                    index.files[t].forEach(gap => wordFiles.add(i += gap));
+                    index.folders[t].forEach(gap => wordFolders.add(fi += gap));
+                }}
+                // A matching folder matches everything below it
+                const stack = [...wordFolders];
+                while (stack.length) {{
+                    const fi = stack.pop();
+                    for (let i = tree.first[fi]; i < tree.first[fi] + tree.count[fi]; i++) wordFiles.add(i);
+                    tree.children[fi].forEach(c => {{
+                        if (!wordFolders.has(c)) {{
+                            wordFolders.add(c);
+                            stack.push(c);
+                        }}
+                    }});
+                }}
+                files = files ? [...files].filter(i => wordFiles.has(i)) : [...wordFiles];
+                folders = folders ? [...folders].filter(fi => wordFolders.has(fi)) : [...wordFolders];
+            }}
+            return {{
+                files: (files || []).sort((a, b) => a - b),
+                folders: (folders || []).sort((a, b) => a - b)
+            }};
+        }}
+
+        function setFileTable(data) {{
+            // Users without a payload or shard get [], an empty list
+            if (Array.isArray(data)) data = {empty_table_json};
+            fileTable = data;
+            fileRows = [];
+            folderLookup = new Map(data ? data.folders.map((path, i) => [path, i]) : []);
+        }}
+
+        // The decoded list is kept in IndexedDB rather than sessionStorage,
+        // which is capped at around 5 MB and had to be parsed in full on every
+        // reload. Records are keyed by user and payload version: one holds the
+        // table without its file columns, and each folder's columns have their
+        // own record, read the first time the folder is shown.
+        const FILE_DB = 'fileshare';
+        const FILE_COLUMNS = ['name', 'id', 'size', 'cat', 'thumb'];
+        let fileDb = null;
+
+        function openFileDb() {{
+            if (!fileDb) {{
+                fileDb = new Promise((resolve, reject) => {{
+                    if (typeof indexedDB === 'undefined') throw new Error('IndexedDB is not available');
+                    const request = indexedDB.open(FILE_DB, 1);
+                    request.onupgradeneeded = () => {{
+                        request.result.createObjectStore('tables');
+                        request.result.createObjectStore('folders');
+                    }};
+                    request.onsuccess = () => resolve(request.result);
+                    request.onerror = () => reject(request.error);
+                }});
+            }}
+            return fileDb;
+        }}
+
+        function dbRequest(request) {{
+            return new Promise((resolve, reject) => {{
+                request.onsuccess = () => resolve(request.result);
+                request.onerror = () => reject(request.error);
+            }});
+        }}
+
+        function dbTransaction(tx) {{
+            return new Promise((resolve, reject) => {{
+                tx.oncomplete = () => resolve();
+                tx.onerror = tx.onabort = () => reject(tx.error);
+            }});
+        }}
+
+        async function saveFileTable(username, table) {{
+            const db = await openFileDb();
+            const tx = db.transaction(['tables', 'folders'], 'readwrite');
+            const version = PAYLOAD_VERSIONS[username] || '';
+            // Older versions of this user's list go first
+            const user = IDBKeyRange.bound([username], [username, []]);
+            tx.objectStore('tables').delete(user);
+            tx.objectStore('folders').delete(user);
+            const header = {{}};
+            for (const key in table) {{
+                if (!FILE_COLUMNS.includes(key) && key !== 'folder') header[key] = table[key];
+            }}
+            header.columns = FILE_COLUMNS.filter(c => table[c]);
+            tx.objectStore('tables').put(header, [username, version]);
+            table.tree.count.forEach((count, node) => {{
+                if (!count) return;
+                const first = table.tree.first[node];
+                const rows = {{}};
+                header.columns.forEach(c => rows[c] = table[c].slice(first, first + count));
+                tx.objectStore('folders').put(rows, [username, version, node]);
+            }});
+            await dbTransaction(tx);
+        }}
+
+        async function restoreFileTable(username) {{
+            // The stored table with empty columns, or null if there's none for
+            // the current payload
+            const db = await openFileDb();
+            const key = [username, PAYLOAD_VERSIONS[username] || ''];
+            const table = await dbRequest(db.transaction('tables').objectStore('tables').get(key));
+            if (!table) return null;
+            const count = table.tree.count.reduce((a, b) => a + b, 0);
+            table.columns.concat('folder').forEach(c => table[c] = new Array(count));
+            table.key = key;
+            table.loaded = new Uint8Array(table.folders.length);
+            return table;
+        }}
+
+        async function loadFolders(nodes) {{
+            // Fill in the columns of a restored table's folders
+            const table = fileTable;
+            const db = await openFileDb();
+            const store = db.transaction('folders').objectStore('folders');
+            const records = await Promise.all(nodes.map(node => dbRequest(store.get(table.key.concat(node)))));
+            records.forEach((rows, k) => {{
+                if (!rows) throw new Error('folder ' + nodes[k] + ' is missing');
+                const node = nodes[k];
+                const first = table.tree.first[node];
+                for (const c in rows) {{
+                    rows[c].forEach((value, i) => table[c][first + i] = value);
+                }}
+                table.folder.fill(node, first, first + table.tree.count[node]);
+                table.loaded[node] = 1;
+            }});
+        }}
+
+        function missingFolders(nodes) {{
+            if (!fileTable || !fileTable.loaded) return [];
+            return nodes.filter(node => fileTable.tree.count[node] && !fileTable.loaded[node]);
+        }}
+
+        async function clearFileDb() {{
+            const db = await openFileDb();
+            const tx = db.transaction(['tables', 'folders'], 'readwrite');
+            tx.objectStore('tables').clear();
+            tx.objectStore('folders').clear();
+            await dbTransaction(tx);
+        }}
+
+        function fileCount() {{
+            return fileTable ? fileTable.name.length : 0;
+        }}
+
+        function fileAt(i) {{
+            if (!fileRows[i]) {{
+                fileRows[i] = {{
+                    index: i,
+                    name: fileTable.name[i],
+                    id: fileTable.id[i],
+                    size: formatBytes(fileTable.size[i]),
+                    category: fileTable.cats[fileTable.cat[i]],
+                    folder: fileTable.folders[fileTable.folder[i]],
+                    thumb: fileTable.thumb ? fileTable.thumb[i] : -1
+                }};
+            }}
+            return fileRows[i];
+        }}
+
+        function spriteStyle(f) {{
+            // The file's tile in its sprite sheet (see build_thumbnails.py)
+            const columns = fileTable.sheetColumns;
+            const sheet = fileTable.sheets[Math.floor(f.thumb / (columns * columns))];
+            const pos = f.thumb % (columns * columns);
+            const x = (pos % columns) * 100 / (columns - 1), y = Math.floor(pos / columns) * 100 / (columns - 1);
+            return 'background-image:url(' + sheet + ');background-size:' + columns * 100 + '% ' + columns * 100 + '%;background-position:' + x + '% ' + y + '%';
+        }}
+
+        function formatBytes(size) {{
+            // Same output as format_bytes in gdrive_sync.py
+            if (typeof size !== 'number') return size;
+            for (const unit of ['B', 'KB', 'MB', 'GB', 'TB']) {{
+                if (size < 1024) return size.toFixed(1) + ' ' + unit;
+                size /= 1024;
+            }}
+            return size.toFixed(1) + ' PB';
+        }}
 
         async function sha256(message) {{
             const msgBuffer = new TextEncoder().encode(message);
@@ -934,6 +1485,25 @@ def generate_index_html(users_data, users_config):
             return hashHex;
         }}
 
+        async function loadUserFiles(username, passwordHash) {{
+            let source;
+            if (SHARDED) {{
+                // Fetch only this user's shard; its name is derived from the password hash
+                const shardId = (await sha256(passwordHash + ':' + username)).slice(0, 32);
+                source = {{url: 'data/' + shardId + '.bin'}};
+            }} else {{
+                const enc = USER_FILES_ENC[username] || '';
+                if (!enc) return [];
+                source = {{b64: enc}};
+            }}
+            const started = performance.now();
+            const {{files, timings}} = await decodeUserFiles(source, passwordHash);
+            console.info('Loaded files in ' + Math.round(performance.now() - started) + ' ms ' +
+                         '(' + timings.thread + ' thread, ' + timings.cipher + ': ' + ['fetch', 'decrypt', 'inflate', 'parse']
+                             .filter(step => step in timings).map(step => step + ' ' + timings[step] + ' ms').join(', ') + ')');
+            return files;
+        }}
+
         async function login() {{
             const username = document.getElementById('username').value.trim().toLowerCase();
             const password = document.getElementById('password').value;
@@ -956,25 +1526,31 @@ def generate_index_html(users_data, users_config):
             }}
 
             // Decrypt file data using the password hash
-            const enc = USER_FILES_ENC[username] || '';
-            let decrypted = [];
-            if (enc) {{
-                try {{
-                    decrypted = JSON.parse(xorDecrypt(enc, passwordHash));
-                }} catch(e) {{
-                    errorDiv.textContent = 'error decrypting files';
-                    return;
-                }}
+            try {{
+                await decryptFileTable(username, passwordHash);
+            }} catch(e) {{
+                errorDiv.textContent = 'error decrypting files';
+                return;
             }}
-            sessionStorage.setItem('userFiles', JSON.stringify(decrypted));
+            // Kept so a reload can decrypt again when the stored list is gone
+            // or out of date; it's the hash the page already publishes
+            sessionStorage.setItem('passwordHash', passwordHash);
             sessionStorage.setItem('username', username);
             sessionStorage.setItem('displayName', username.charAt(0).toUpperCase() + username.slice(1));
             showFiles();
         }}
 
+        async function decryptFileTable(username, passwordHash) {{
+            setFileTable(await loadUserFiles(username, passwordHash));
+            saveFileTable(username, fileTable).catch(e => {{
+                console.warn('Files will be decrypted again on reload:', e.message || e);
+            }});
+        }}
+
         function logout() {{
             sessionStorage.clear();
-            currentFiles = [];
+            setFileTable(null);
+            clearFileDb().catch(() => {{}});
             document.getElementById('loginSection').classList.remove('hidden');
             document.getElementById('filesSection').classList.remove('active');
             document.getElementById('detailView').classList.remove('active');
@@ -983,7 +1559,7 @@ def generate_index_html(users_data, users_config):
             document.getElementById('loginError').textContent = '';
         }}
 
-        function showFiles() {{
+        async function showFiles() {{
             const username = sessionStorage.getItem('username');
             if (!username) return;
 
@@ -992,13 +1568,25 @@ def generate_index_html(users_data, users_config):
             document.getElementById('detailView').classList.remove('active');
             document.getElementById('displayName').textContent = sessionStorage.getItem('displayName');
 
-            try {{
-                currentFiles = JSON.parse(sessionStorage.getItem('userFiles') || '[]');
-            }} catch(e) {{
-                currentFiles = [];
+            if (!fileTable) {{
+                // A reload: use the stored list, or decrypt the payload again
+                // if there's none for the current build
+                try {{
+                    setFileTable(await restoreFileTable(username));
+                }} catch(e) {{
+                    console.warn('Could not restore files:', e.message || e);
+                }}
+                if (!fileTable) {{
+                    try {{
+                        await decryptFileTable(username, sessionStorage.getItem('passwordHash'));
+                    }} catch(e) {{
+                        setFileTable([]);
+                    }}
+                }}
             }}
             currentView = 'root';
             currentFolder = '';
+            clearSearch();
             renderFileList();
         }}
 
@@ -1016,43 +1604,71 @@ def generate_index_html(users_data, users_config):
         let currentView = 'root';
         let currentFolder = '';
         let levelFiles = [];
-        let folderNames = [];
+        let folderPaths = [];
+        let searchQuery = '';
+
+        function onSearch(value) {{
+            searchQuery = value.trim();
+            renderFileList();
+        }}
+
+        function clearSearch() {{
+            searchQuery = '';
+            document.getElementById('searchBox').value = '';
+        }}
+
+        function rowName(f) {{
+            // Search results can come from anywhere, so show where
+            return searchQuery && f.folder ? f.folder + '/' + f.name : f.name;
+        }}
 
         function renderFileList() {{
+            // A restored list reads each folder's files the first time it's
+            // shown; a search needs all of them
+            if (fileTable) {{
+                const node = folderLookup.get(currentFolder);
+                const missing = missingFolders(searchQuery ? fileTable.tree.count.map((c, i) => i) : node === undefined ? [] : [node]);
+                if (missing.length) {{
+                    loadFolders(missing).then(renderFileList, e => {{
+                        console.warn('Decrypting files again:', e.message || e);
+                        decryptFileTable(sessionStorage.getItem('username'), sessionStorage.getItem('passwordHash'))
+                            .then(renderFileList, () => {{}});
+                    }});
+                    return;
+                }}
+            }}
+
             const grid = document.getElementById('filesGrid');
-            if (!currentFiles.length) {{
+            if (!fileCount()) {{
                 grid.innerHTML = '<p class="no-files">no files available</p>';
                 return;
             }}
 
-            const prefix = currentFolder ? currentFolder + '/' : '';
-
-            // Files directly at this level
-            levelFiles = currentFolder
-                ? currentFiles.filter(f => f.folder === currentFolder)
-                : currentFiles.filter(f => !f.folder);
-
-            // Subfolders at this level
-            const subfolderSet = new Set();
-            currentFiles.forEach(f => {{
-                if (!f.folder) return;
-                if (currentFolder) {{
-                    if (f.folder.startsWith(prefix) && f.folder !== currentFolder) {{
-                        const rest = f.folder.slice(prefix.length);
-                        const next = rest.split('/')[0];
-                        if (next) subfolderSet.add(next);
-                    }}
-                }} else {{
-                    subfolderSet.add(f.folder.split('/')[0]);
+            // Subfolders and files at this level come straight from the
+            // precomputed tree (see encode_file_list), or from the search index
+            const tree = fileTable.tree;
+            let subfolders = [];
+            levelFiles = [];
+            if (searchQuery) {{
+                const hits = searchFiles(searchQuery);
+                subfolders = hits.folders;
+                hits.files.forEach(i => levelFiles.push(fileAt(i)));
+            }} else {{
+                const node = folderLookup.get(currentFolder);
+                if (node !== undefined) {{
+                    subfolders = tree.children[node];
+                    for (let i = tree.first[node]; i < tree.first[node] + tree.count[node]; i++) levelFiles.push(fileAt(i));
                 }}
-            }});
-            const subfolders = [...subfolderSet].sort();
-            folderNames = subfolders;
+            }}
+            folderPaths = subfolders.map(c => fileTable.folders[c]);
 
             let html = '';
 
             // Back button + heading when inside a folder
-            if (currentFolder) {{
+            if (searchQuery) {{
+                const count = subfolders.length + levelFiles.length;
+                html += '<div class="folder-heading"><span>' + count + ' result' + (count !== 1 ? 's' : '') + '</span></div>';
+            }} else if (currentFolder) {{
                 html += '<div class="folder-heading">' + folderSvg + '<span>' + currentFolder + '</span></div>';
                 html += '<a class="action-btn back-folder-btn" href="#" onclick="event.preventDefault();goBack()">\u2190 back</a>';
             }}
@@ -1060,9 +1676,9 @@ def generate_index_html(users_data, users_config):
             // Render subfolders
             if (subfolders.length) {{
                 html += '<table class="file-table">';
-                subfolders.forEach((name, fi) => {{
-                    const fullPath = currentFolder ? currentFolder + '/' + name : name;
-                    const count = currentFiles.filter(f => f.folder && (f.folder === fullPath || f.folder.startsWith(fullPath + '/'))).length;
+                folderPaths.forEach((path, fi) => {{
+                    const name = searchQuery ? path : path.slice(path.lastIndexOf('/') + 1);
+                    const count = tree.total[subfolders[fi]];
                     html += '<tr class="file-row folder-row" onclick="openFolder(' + fi + ')">';
                     html += '<td class="col-icon">' + folderSvg + '<span class="type-label">folder</span></td>';
                     html += '<td class="col-name">' + name + '</td>';
@@ -1075,18 +1691,24 @@ def generate_index_html(users_data, users_config):
                 html += '</table>';
             }}
 
-            // Render files at this level
-            if (levelFiles.length) {{
+            // Render files at this level; big folders get a window of rows
+            // that follows the scroll position (see updateFileWindow)
+            const windowed = levelFiles.length > VIRTUAL_MIN_FILES;
+            if (windowed) {{
+                html += '<table class="file-table" id="fileWindow"><tr class="file-spacer"><td colspan="4"></td></tr><tr class="file-spacer"><td colspan="4"></td></tr></table>';
+            }} else if (levelFiles.length) {{
                 html += '<table class="file-table">';
                 levelFiles.forEach((f, i) => {{
-                    const gi = currentFiles.indexOf(f);
+                    const gi = f.index;
                     html += '<tr class="file-row">';
-                    if (f.category === 'image') {{
+                    if (f.category === 'image' && f.thumb >= 0) {{
+                        html += '<td class="col-icon">' + fileIcon(f.category) + '<span class="thumb" style="' + spriteStyle(f) + '"></span><span class="type-label">' + catLabel(f.category) + '</span></td>';
+                    }} else if (f.category === 'image') {{
                         html += '<td class="col-icon">' + fileIcon(f.category) + '<img class="thumb" src="https://drive.google.com/thumbnail?id=' + f.id + '&sz=w56" alt=""><span class="type-label">' + catLabel(f.category) + '</span></td>';
                     }} else {{
                         html += '<td class="col-icon">' + fileIcon(f.category) + '<span class="type-label">' + catLabel(f.category) + '</span></td>';
                     }}
-                    html += '<td class="col-name">' + f.name + '</td>';
+                    html += '<td class="col-name">' + rowName(f) + '</td>';
                     html += '<td class="col-size">' + f.size + '</td>';
                     html += '<td class="col-actions">';
                     html += '<a class="action-btn" href="#" onclick="event.preventDefault();openFileDetail(' + gi + ',' + i + ')">view file</a>';
@@ -1098,15 +1720,117 @@ def generate_index_html(users_data, users_config):
             }}
 
             if (!subfolders.length && !levelFiles.length) {{
-                html += '<p class="no-files">' + (currentFolder ? 'no files in this folder' : 'no files available') + '</p>';
+                html += '<p class="no-files">' + (searchQuery ? 'no matching files' : currentFolder ? 'no files in this folder' : 'no files available') + '</p>';
             }}
             grid.innerHTML = html;
+            fileWindow = null;
+            if (windowed) {{
+                const table = document.getElementById('fileWindow');
+                const spacers = table.querySelectorAll('.file-spacer');
+                fileWindow = {{table, top: spacers[0], bottom: spacers[1], rowHeight: 53, byLevel: new Map(), pool: []}};
+                updateFileWindow();
+            }}
+        }}
+
+        // Folders with more files than this are rendered as a window of
+        // reused rows around the viewport instead of one row per file
+        const VIRTUAL_MIN_FILES = 200;
+        const VIRTUAL_OVERSCAN = 10;
+        let fileWindow = null;
+        let fileWindowPending = false;
+
+        function createFileRow() {{
+            const row = document.createElement('tr');
+            row.className = 'file-row';
+            row.innerHTML = '<td class="col-icon"><span></span><img class="thumb" alt=""><span class="thumb"></span><span class="type-label"></span></td><td class="col-name"></td><td class="col-size"></td><td class="col-actions"><a class="action-btn" href="#">view file</a><a class="action-btn" download>download file</a></td>';
+            const [icon, thumb, sprite, label] = row.cells[0].children;
+            const [view, download] = row.cells[3].children;
+            const slot = {{row, icon, thumb, sprite, label, name: row.cells[1], size: row.cells[2], download, level: -1}};
+            view.onclick = e => {{
+                e.preventDefault();
+                openFileDetail(levelFiles[slot.level].index, slot.level);
+            }};
+            return slot;
+        }}
+
+        function fillFileRow(slot, i) {{
+            const f = levelFiles[i];
+            slot.level = i;
+            slot.icon.innerHTML = fileIcon(f.category);
+            slot.label.textContent = catLabel(f.category);
+            slot.name.textContent = rowName(f);
+            slot.size.textContent = f.size;
+            slot.download.href = downloadUrl(f);
+            slot.thumb.removeAttribute('src');
+            slot.thumb.style.display = f.category === 'image' && f.thumb < 0 ? '' : 'none';
+            slot.sprite.style.cssText = f.category === 'image' && f.thumb >= 0 ? '' : 'display:none';
+        }}
+
+        function updateFileWindow() {{
+            fileWindowPending = false;
+            const w = fileWindow;
+            if (!w || !w.table.isConnected) return;
+            const n = levelFiles.length;
+            const top = w.table.getBoundingClientRect().top;
+            const firstVisible = Math.min(n, Math.max(0, Math.floor(-top / w.rowHeight)));
+            const lastVisible = Math.min(n, Math.max(firstVisible, Math.ceil((window.innerHeight - top) / w.rowHeight)));
+            const start = Math.max(0, firstVisible - VIRTUAL_OVERSCAN);
+            const end = Math.min(n, lastVisible + VIRTUAL_OVERSCAN);
+
+            // Release rows that scrolled out of the window, then hand them
+            // (or new ones, while the window grows) to rows scrolling in
+            w.byLevel.forEach((slot, i) => {{
+                if (i < start || i >= end) {{
+                    w.byLevel.delete(i);
+                    slot.row.remove();
+                    w.pool.push(slot);
+                }}
+            }});
+            let prev = w.top;
+            for (let i = start; i < end; i++) {{
+                let slot = w.byLevel.get(i);
+                if (!slot) {{
+                    slot = w.pool.pop() || createFileRow();
+                    fillFileRow(slot, i);
+                    w.byLevel.set(i, slot);
+                }}
+                if (prev.nextSibling !== slot.row) prev.parentNode.insertBefore(slot.row, prev.nextSibling);
+                // Thumbnails only start loading once their row is on screen
+                const f = levelFiles[i];
+                if (i >= firstVisible && i < lastVisible && f.category === 'image') {{
+                    if (f.thumb >= 0) {{
+                        if (!slot.sprite.style.backgroundImage) slot.sprite.style.cssText = spriteStyle(f);
+                    }} else if (!slot.thumb.getAttribute('src')) {{
+                        slot.thumb.src = 'https://drive.google.com/thumbnail?id=' + f.id + '&sz=w56';
+                    }}
+                }}
+                prev = slot.row;
+            }}
+
+            // Rows outside the window are stood in for by the spacers, sized
+            // with the average height of the rows actually rendered
+            if (end > start) {{
+                const rendered = w.bottom.getBoundingClientRect().top - w.top.getBoundingClientRect().bottom;
+                if (rendered > 0) w.rowHeight = rendered / (end - start);
+            }}
+            w.top.cells[0].style.height = (start * w.rowHeight) + 'px';
+            w.bottom.cells[0].style.height = ((n - end) * w.rowHeight) + 'px';
         }}
 
+        function scheduleFileWindow() {{
+            if (!fileWindow || fileWindowPending) return;
+            fileWindowPending = true;
+            requestAnimationFrame(updateFileWindow);
+        }}
+
+        window.addEventListener('scroll', scheduleFileWindow, {{passive: true}});
+        window.addEventListener('resize', scheduleFileWindow);
+
         function openFolder(idx) {{
-            const name = folderNames[idx];
-            if (!name) return;
-            currentFolder = currentFolder ? currentFolder + '/' + name : name;
+            const path = folderPaths[idx];
+            if (!path) return;
+            clearSearch();
+            currentFolder = path;
             currentView = 'folder';
             history.pushState({{view: 'folder', folder: currentFolder}}, '');
             renderFileList();
@@ -1126,13 +1850,13 @@ def generate_index_html(users_data, users_config):
         let navContext = 'none';
 
         function openFileDetail(globalIdx, levelIdx) {{
-            if (currentFolder && levelFiles.length > 1) {{
+            if ((currentFolder || searchQuery) && levelFiles.length > 1) {{
                 navContext = 'folder';
                 currentIndex = levelIdx;
             }} else {{
                 navContext = 'none';
             }}
-            showDetail(currentFiles[globalIdx]);
+            showDetail(fileAt(globalIdx));
         }}
 
         function showDetail(file) {{
@@ -1201,6 +1925,7 @@ def generate_index_html(users_data, users_config):
             if (currentView === 'folder') {{
                 renderFileList();
             }}
+            scheduleFileWindow();
         }}
 
         // Fullscreen mode
@@ -1295,16 +2020,25 @@ def generate_index_html(users_data, users_config):
             }} else if (e.state && e.state.view === 'folder') {{
                 currentView = 'folder';
                 currentFolder = e.state.folder || '';
+                clearSearch();
                 renderFileList();
             }} else {{
                 currentView = 'root';
                 currentFolder = '';
+                clearSearch();
                 renderFileList();
             }}
         }});
 
         if (sessionStorage.getItem('username')) {{
             showFiles();
+        }} else if (typeof indexedDB !== 'undefined') {{
+            // Lists stored by a session that has since ended
+            clearFileDb().catch(() => {{}});
+        }}
+
+        if ('serviceWorker' in navigator && location.protocol !== 'file:') {{
+            navigator.serviceWorker.register('sw.js');
         }}
 
         document.getElementById('password').addEventListener('keypress', function(event) {{
@@ -1318,45 +2052,391 @@ def generate_index_html(users_data, users_config):
     
     return html
 
-def generate_site(users_data_file, users_config_file, output_dir):
-    """Generate the static site."""
-    output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Load data
+# Shared by the page and its decrypt worker. Turns an encrypted payload
+# ({url} of a shard or {b64} of an inline payload) into the file list,
+# timing each step.
+PAYLOAD_DECODER_JS = """\
+        function xorDecrypt(bytes, key) {
+            const keyBytes = new TextEncoder().encode(key);
+            let i = 0;
+            if (keyBytes.length % 4 === 0 && bytes.byteOffset % 4 === 0) {
+                // Whole 32-bit words at a time, then any trailing bytes
+                const words = new Uint32Array(bytes.buffer, bytes.byteOffset, bytes.length >> 2);
+                const keyWords = new Uint32Array(keyBytes.buffer, keyBytes.byteOffset, keyBytes.length >> 2);
+                for (let w = 0; w < words.length; w++) {
+                    words[w] ^= keyWords[w % keyWords.length];
+                }
+                i = words.length << 2;
+            }
+            for (; i < bytes.length; i++) {
+                bytes[i] ^= keyBytes[i % keyBytes.length];
+            }
+            return bytes;
+        }
+
+        // First byte of an AES-GCM payload (PAYLOAD_AES_GCM in the generator);
+        // XOR payloads have no header
+        const PAYLOAD_AES_GCM = 1;
+
+        async function aesGcmDecrypt(bytes, key) {
+            // Native WebCrypto; the AES key is the SHA-256 of the password hash
+            const keyBytes = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(key));
+            const aesKey = await crypto.subtle.importKey('raw', keyBytes, 'AES-GCM', false, ['decrypt']);
+            const plain = await crypto.subtle.decrypt(
+                {name: 'AES-GCM', iv: bytes.subarray(1, 13), additionalData: bytes.subarray(0, 1)},
+                aesKey, bytes.subarray(13));
+            return new Uint8Array(plain);
+        }
+
+        async function inflate(bytes) {
+            const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+            return new Uint8Array(await new Response(stream).arrayBuffer());
+        }
+
+        async function loadPayload(source, key, compressed) {
+            const timings = {};
+            let t = performance.now();
+            const lap = step => {
+                const now = performance.now();
+                timings[step] = Math.round(now - t);
+                t = now;
+            };
+            let bytes;
+            if (source.url) {
+                const resp = await fetch(source.url, {cache: 'no-cache'});
+                if (resp.status === 404) return {files: [], timings};
+                if (!resp.ok) throw new Error('failed to load files: ' + resp.status);
+                bytes = new Uint8Array(await resp.arrayBuffer());
+            } else {
+                bytes = Uint8Array.from(atob(source.b64), c => c.charCodeAt(0));
+            }
+            lap('fetch');
+            if (bytes[0] === PAYLOAD_AES_GCM) {
+                bytes = await aesGcmDecrypt(bytes, key);
+                timings.cipher = 'aes-gcm';
+            } else {
+                xorDecrypt(bytes, key);
+                timings.cipher = 'xor';
+            }
+            lap('decrypt');
+            if (compressed) {
+                bytes = await inflate(bytes);
+                lap('inflate');
+            }
+            const files = JSON.parse(new TextDecoder().decode(bytes));
+            lap('parse');
+            return {files, timings};
+        }
+"""
+
+DECRYPT_WORKER_NAME = 'decrypt-worker.js'
+
+def generate_decrypt_worker():
+    """Web worker that decodes a user's payload off the page's main thread."""
+    return f'''// Generated by generate_site.py
+{textwrap.dedent(PAYLOAD_DECODER_JS)}
+self.onmessage = async event => {{
+    const {{source, key, compressed}} = event.data;
+    try {{
+        const result = await loadPayload(source, key, compressed);
+        result.timings.thread = 'worker';
+        self.postMessage(result);
+    }} catch (e) {{
+        self.postMessage({{error: String(e)}});
+    }}
+}};
+'''
+
+THUMBNAIL_CACHE_LIMIT = 500
+
+def generate_service_worker(version):
+    """
+    Service worker that serves the page from cache, so repeat visits don't wait on the network.
+    version should be derived from the page, so that a new build replaces the cached one.
+    """
+    return f'''// Generated by generate_site.py
+const VERSION = '{version}';
+const SHELL_CACHE = 'shell-' + VERSION;
+const DATA_CACHE = 'data-' + VERSION;
+// Only sprite sheets: opaque Drive thumbnails cost several MB of quota each.
+// Renamed from 'thumbs', which also held those, so activate drops it
+const THUMB_CACHE = 'sheets';
+const THUMB_LIMIT = {THUMBNAIL_CACHE_LIMIT};
+// Last use of each sheet since this worker started, by URL, for trimming THUMB_CACHE
+const thumbUse = new Map();
+let thumbClock = 0;
+
+self.addEventListener('install', event => {{
+    event.waitUntil(caches.open(SHELL_CACHE).then(cache => cache.addAll(
+        ['index.html', '{DECRYPT_WORKER_NAME}'].map(url => new Request(url, {{cache: 'reload'}}))
+    )).then(() => self.skipWaiting()));
+}});
+
+self.addEventListener('activate', event => {{
+    event.waitUntil(caches.keys().then(names => Promise.all(
+        names.filter(name => name !== SHELL_CACHE && name !== DATA_CACHE && name !== THUMB_CACHE)
+            .map(name => caches.delete(name))
+    )).then(() => self.clients.claim()));
+}});
+
+async function shellFirst(request) {{
+    const cached = await caches.match('index.html', {{cacheName: SHELL_CACHE}});
+    return cached || fetch(request);
+}}
+
+async function staleWhileRevalidate(event) {{
+    const cache = await caches.open(DATA_CACHE);
+    const cached = await cache.match(event.request);
+    const refresh = fetch(event.request).then(response => {{
+        // Caching is best effort; a failed put (e.g. over quota) must not fail the response
+        if (response.ok) return cache.put(event.request, response.clone()).catch(() => {{}}).then(() => response);
+        if (response.status === 404) return cache.delete(event.request).then(() => response);
+        return response;
+    }});
+    if (!cached) return refresh;
+    event.waitUntil(refresh.catch(() => {{}}));
+    return cached;
+}}
+
+async function recentThumbnail(event) {{
+    const cache = await caches.open(THUMB_CACHE);
+    const cached = await cache.match(event.request);
+    if (cached) {{
+        thumbUse.set(event.request.url, ++thumbClock);
+        return cached;
+    }}
+    const response = await fetch(event.request);
+    if (response.ok) {{
+        event.waitUntil(storeThumbnail(cache, event.request, response.clone()).catch(() => {{}}));
+    }}
+    return response;
+}}
+
+async function storeThumbnail(cache, request, response) {{
+    await cache.put(request, response);
+    thumbUse.set(request.url, ++thumbClock);
+    const keys = await cache.keys();
+    if (keys.length <= THUMB_LIMIT) return;
+    // Sheets not used since the worker started count as oldest, in insertion order
+    const lastUse = (key, i) => thumbUse.get(key.url) || i - keys.length;
+    const oldest = keys.map((key, i) => [lastUse(key, i), key]).sort((a, b) => a[0] - b[0])
+        .slice(0, keys.length - THUMB_LIMIT);
+    await Promise.all(oldest.map(([, key]) => {{
+        thumbUse.delete(key.url);
+        return cache.delete(key);
+    }}));
+}}
+
+self.addEventListener('fetch', event => {{
+    const request = event.request;
+    if (request.method !== 'GET') return;
+    const url = new URL(request.url);
+    if (request.mode === 'navigate' && url.origin === location.origin) {{
+        event.respondWith(shellFirst(request));
+    }} else if (url.origin === location.origin && url.pathname.endsWith('/{DECRYPT_WORKER_NAME}')) {{
+        event.respondWith(caches.match(request, {{cacheName: SHELL_CACHE}}).then(cached => cached || fetch(request)));
+    }} else if (url.origin === location.origin && url.pathname.includes('/data/') && url.pathname.endsWith('.bin')) {{
+        event.respondWith(staleWhileRevalidate(event));
+    }} else if (url.origin === location.origin && url.pathname.includes('/thumbs/')) {{
+        event.respondWith(recentThumbnail(event));
+    }}
+}});
+'''
+
+def load_json_input(path):
+    """Load a JSON input file; {} if the file is missing or invalid."""
     try:
-        with open(users_data_file, 'r') as f:
-            users_data = json.load(f)
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
     except FileNotFoundError:
-        print(f"Error: {users_data_file} not found", file=sys.stderr)
-        users_data = {}
+        print(f"Error: {path} not found", file=sys.stderr)
     except json.JSONDecodeError as e:
-        print(f"Error: Invalid JSON in {users_data_file}: {e}", file=sys.stderr)
-        users_data = {}
-    
+        print(f"Error: Invalid JSON in {path}: {e}", file=sys.stderr)
+    return {}
+
+def iter_users_data(path):
+    """Yield (username, files) pairs from the sync output, reading .jsonl files one user at a time."""
+    if not str(path).endswith('.jsonl'):
+        yield from load_json_input(path).items()
+        return
+
     try:
-        with open(users_config_file, 'r') as f:
-            users_config = json.load(f)
+        f = open(path, 'r', encoding='utf-8')
     except FileNotFoundError:
-        print(f"Error: {users_config_file} not found", file=sys.stderr)
-        users_config = {}
-    except json.JSONDecodeError as e:
-        print(f"Error: Invalid JSON in {users_config_file}: {e}", file=sys.stderr)
-        users_config = {}
-    
-    # Generate HTML
-    html = generate_index_html(users_data, users_config)
-    
-    # Write index.html
+        print(f"Error: {path} not found", file=sys.stderr)
+        return
+    with f:
+        seen = set()
+        username, files = None, []
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Error: Invalid JSON on line {line_number} of {path}: {e}", file=sys.stderr)
+                continue
+            user = record.pop('user')
+            if user != username:
+                if username is not None:
+                    yield username, files
+                if user in seen:
+                    raise ValueError(f"{path}: records for '{user}' are not grouped together (line {line_number})")
+                seen.add(user)
+                username, files = user, []
+            files.append(record)
+        if username is not None:
+            yield username, files
+
+def file_digest(path):
+    """SHA-256 of a file's contents, read in chunks; the digest of b'' if it's missing."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    except FileNotFoundError:
+        pass
+    return digest.digest()
+
+def load_manifest(output_dir):
+    """Load the previous build's manifest, or an empty one."""
+    try:
+        with open(output_dir / MANIFEST_NAME, 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'users': {}}
+    if manifest.get('generator') != GENERATOR_VERSION:
+        return {'users': {}}
+    return manifest
+
+def write_if_changed(path, content):
+    """Write a text file unless it already has this content. Returns True if written."""
+    try:
+        if path.read_text(encoding='utf-8') == content:
+            return False
+    except FileNotFoundError:
+        pass
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    return True
+
+def generate_site(users_data_file, users_config_file, output_dir, force=False, shard=False, compress=True,
+                  thumbnails_file=None, cipher='xor'):
+    """
+    Generate the static site, unless nothing changed since the last build.
+    Returns False if the build was skipped, else True.
+    """
+    STAGE_TIMES.clear()
+    PAYLOAD_SIZES.clear()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
     index_path = output_dir / 'index.html'
-    with open(index_path, 'w', encoding='utf-8') as f:
-        f.write(html)
+    sw_path = output_dir / 'sw.js'
+    
+    with timed('load'):
+        input_digest = hashlib.sha256()
+        options = json.dumps({'shard': shard, 'compress': compress, 'thumbnails': bool(thumbnails_file),
+                              'cipher': cipher}, sort_keys=True).encode('utf-8')
+        for part in (GENERATOR_VERSION.encode('ascii'), options):
+            input_digest.update(hashlib.sha256(part).digest())
+        input_digest.update(file_digest(users_data_file))
+        input_digest.update(file_digest(users_config_file))
+        if thumbnails_file:
+            input_digest.update(file_digest(thumbnails_file))
+        input_digest = input_digest.hexdigest()
+        manifest = load_manifest(output_dir)
+
+    shard_dir = output_dir / 'data'
+    outputs = [index_path, sw_path, output_dir / DECRYPT_WORKER_NAME]
+    outputs += [shard_dir / entry['shard'] for entry in manifest.get('users', {}).values() if 'shard' in entry]
+    if not force and manifest.get('inputs') == input_digest and all(path.exists() for path in outputs):
+        print(f"✓ Inputs unchanged, keeping {index_path}", file=sys.stderr)
+        return False
     
-    print(f"✓ Generated {index_path}", file=sys.stderr)
+    # Load data; the file listing is streamed user by user
+    with timed('load'):
+        users_config = load_json_input(users_config_file)
+        users_data = timed_iter(iter_users_data(users_data_file), 'load')
+        thumbnails = load_json_input(thumbnails_file) if thumbnails_file else None
+
+    # Generate HTML, reusing unchanged payloads from the previous build
+    payload_cache = manifest.get('users', {})
+    with timed('load'):
+        embedded = {} if shard else load_embedded_payloads(index_path, payload_cache)
+    html = generate_index_html(users_data, users_config, payload_cache, shard_dir if shard else None, compress,
+                               thumbnails, cipher, embedded)
+    # The worker's version follows the generator and the page it caches
+    version = hashlib.sha256(f"{GENERATOR_VERSION}\0{html}".encode('utf-8')).hexdigest()[:16]
+    manifest = {'generator': GENERATOR_VERSION, 'inputs': input_digest, 'users': payload_cache}
+
+    with timed('write'):
+        remove_stale_shards(shard_dir, payload_cache)
+
+        # Write index.html
+        if write_if_changed(index_path, html):
+            print(f"✓ Generated {index_path}", file=sys.stderr)
+        else:
+            print(f"✓ {index_path} unchanged", file=sys.stderr)
+
+        if write_if_changed(output_dir / DECRYPT_WORKER_NAME, generate_decrypt_worker()):
+            print(f"✓ Generated {output_dir / DECRYPT_WORKER_NAME}", file=sys.stderr)
+
+        if write_if_changed(sw_path, generate_service_worker(version)):
+            print(f"✓ Generated {sw_path} (cache version {version})", file=sys.stderr)
+
+        write_if_changed(output_dir / MANIFEST_NAME, json.dumps(manifest, indent=1, sort_keys=True) + '\n')
+    return True
+
+def build_metrics(seconds, built):
+    """Summarise the last generate_site run for --metrics-out."""
+    return {
+        'version': METRICS_VERSION,
+        'seconds': round(seconds, 3),
+        'skipped': not built,
+        'stages': {stage: round(float(STAGE_TIMES[stage]), 3) for stage in STAGES},
+        'users': dict(sorted(PAYLOAD_SIZES.items())),
+    }
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python generate_site.py <users_data.json> <users_config.json> <output_dir>", file=sys.stderr)
+    parser = argparse.ArgumentParser(description="Generate the static file share site.")
+    parser.add_argument('users_data', help="synced file listing (gdrive_files.json or .jsonl)")
+    parser.add_argument('users_config', help="user credentials (users.json)")
+    parser.add_argument('output_dir', help="directory to write the site to")
+    parser.add_argument('--force', action='store_true',
+                        help="rebuild even if the inputs are unchanged since the last build")
+    parser.add_argument('--shard', action='store_true',
+                        help="write each user's files to data/<id>.bin, loaded after login, instead of embedding them")
+    parser.add_argument('--no-compress', dest='compress', action='store_false',
+                        help="don't deflate file lists before encrypting them")
+    parser.add_argument('--thumbnails', metavar='PATH',
+                        help="thumbnail sheet manifest from build_thumbnails.py")
+    parser.add_argument('--cipher', choices=CIPHERS, default='xor',
+                        help="payload encryption; aes-gcm is decrypted natively by the browser (default: xor)")
+    parser.add_argument('--metrics-out', metavar='PATH',
+                        help="write per-stage times and per-user payload sizes for this run here as JSON")
+    args = parser.parse_args()
+
+    if args.cipher == 'aes-gcm' and AESGCM is None:
+        print("Error: --cipher aes-gcm requires the cryptography package (pip install cryptography)", file=sys.stderr)
         sys.exit(1)
     
-    generate_site(sys.argv[1], sys.argv[2], sys.argv[3])
+    started = time.perf_counter()
+    built = False
+    error = None
+    try:
+        built = generate_site(args.users_data, args.users_config, args.output_dir, force=args.force,
+                              shard=args.shard, compress=args.compress, thumbnails_file=args.thumbnails,
+                              cipher=args.cipher)
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        if args.metrics_out:
+            metrics = build_metrics(time.perf_counter() - started, built)
+            if error:
+                metrics['error'] = error
+            Path(args.metrics_out).parent.mkdir(parents=True, exist_ok=True)
+            with open(args.metrics_out, 'w', encoding='utf-8') as f:
+                json.dump(metrics, f, separators=(',', ':'))
+            print(f"✓ Wrote metrics to {args.metrics_out}", file=sys.stderr)